@@ -0,0 +1,57 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2024, magicprotoss;biodps.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+# Wall time vs. size of the gzip backends on a synthetic fastq.
+# usage: python benchmarks/bench_compression.py [n_reads]
+
+import os
+import sys
+import time
+import random
+import tempfile
+
+from q2_usearch._compress import gzip_writer
+
+
+def make_fastq(n_reads, read_len=250, seed=42):
+    rng = random.Random(seed)
+    # a handful of "species" with sequencing noise compresses like real data
+    templates = [''.join(rng.choice('ACGT') for _ in range(read_len))
+                 for _ in range(50)]
+    records = []
+    for i in range(n_reads):
+        seq = list(rng.choice(templates))
+        for _ in range(rng.randint(0, 3)):
+            seq[rng.randrange(read_len)] = rng.choice('ACGT')
+        qual = ''.join(chr(33 + max(2, 38 - int(rng.expovariate(0.3))))
+                       for _ in range(read_len))
+        records.append('@M00001:1:000000000-AAAAA:1:1101:%d:%d 1:N:0:1\n%s\n+\n%s\n'
+                       % (i, i, ''.join(seq), qual))
+    return ''.join(records).encode('ascii')
+
+
+def main():
+    n_reads = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    data = make_fastq(n_reads)
+    print("input: %d reads, %.1f MB" % (n_reads, len(data) / 1e6))
+    print("%-8s %6s %8s %10s %7s" % ('level', 'thr', 'time_s', 'size_MB', 'ratio'))
+    with tempfile.TemporaryDirectory() as wd:
+        fp = os.path.join(wd, 'out.fastq.gz')
+        for level in (1, 3, 6, 9):
+            for threads in sorted({1, 2, 4, os.cpu_count() or 1}):
+                start = time.perf_counter()
+                with gzip_writer(fp, level, threads) as fh:
+                    fh.write(data)
+                elapsed = time.perf_counter() - start
+                size = os.path.getsize(fp)
+                print("%-8d %6d %8.2f %10.2f %7.2f" % (
+                    level, threads, elapsed, size / 1e6, len(data) / size))
+
+
+if __name__ == '__main__':
+    main()
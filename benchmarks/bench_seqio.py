@@ -0,0 +1,76 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2024, magicprotoss;biodps.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+# Reading and writing a fasta file with q2_usearch._seqio vs. skbio.
+# usage: python benchmarks/bench_seqio.py [n_records]
+
+import os
+import sys
+import time
+import random
+import tempfile
+
+import skbio
+
+from q2_usearch._seqio import (read_fasta, read_fasta_labels,
+                               write_fasta_record)
+
+
+def make_fasta(fp, n_records, seed=42):
+    rng = random.Random(seed)
+    templates = [''.join(rng.choice('ACGT') for _ in range(253)) for _ in range(100)]
+    with open(fp, 'wt') as fh:
+        for i in range(n_records):
+            seq = rng.choice(templates)
+            fh.write('>S%d.%d\n%s\n' % (i % 96, i, seq))
+
+
+def timed(label, func):
+    start = time.perf_counter()
+    n = func()
+    print("%-40s %10.2f %12d" % (label, time.perf_counter() - start, n))
+
+
+def main():
+    n_records = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    print("%-40s %10s %12s" % ('task', 'time_s', 'records'))
+    with tempfile.TemporaryDirectory() as wd:
+        fp = os.path.join(wd, 'in.fasta')
+        out_fp = os.path.join(wd, 'out.fasta')
+        make_fasta(fp, n_records)
+
+        timed('skbio: ids and sequences', lambda: sum(
+            1 for seq in skbio.io.registry.read(fp, format='fasta', verify=True)
+            if seq.metadata['id'] and str(seq)))
+        timed('_seqio.read_fasta', lambda: sum(
+            1 for label, seq in read_fasta(fp) if label and seq))
+        timed('_seqio.read_fasta_labels', lambda: sum(
+            1 for _ in read_fasta_labels(fp)))
+
+        def skbio_write():
+            with open(out_fp, 'wt') as fh:
+                n = 0
+                for seq in skbio.io.registry.read(fp, format='fasta'):
+                    seq.write(fh, format='fasta', max_width=80)
+                    n += 1
+            return n
+
+        def seqio_write():
+            with open(out_fp, 'wb') as fh:
+                n = 0
+                for label, seq in read_fasta(fp):
+                    write_fasta_record(fh, label, seq)
+                    n += 1
+            return n
+
+        timed('skbio: read + write (width 80)', skbio_write)
+        timed('_seqio: read + write (width 80)', seqio_write)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2024, magicprotoss;biodps.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+# Wall time of _split_zotu_chimera (vsearch branch) vs. number of amplicons,
+# time per amplicon should stay flat.
+# usage: python benchmarks/bench_split_chimeras.py [max_amplicons]
+
+import os
+import sys
+import time
+import random
+import hashlib
+import tempfile
+
+from q2_usearch._illumina_pipeline import _split_zotu_chimera
+
+
+def make_amplicons(working_dir, n_amplicons, chimera_rate=0.2, seed=42):
+    rng = random.Random(seed)
+    with open(os.path.join(working_dir, "vsearch_amps.fasta"), 'wt') as amps_fh, \
+            open(os.path.join(working_dir, "zotus.fasta"), 'wt') as zotus_fh:
+        for i in range(n_amplicons):
+            seq = ''.join(rng.choice('ACGT') for _ in range(rng.randint(240, 260)))
+            amps_fh.write('>centroid%d;size=%d\n%s\n' % (i, n_amplicons - i, seq))
+            if rng.random() >= chimera_rate:
+                seq_id = hashlib.md5(seq.encode()).hexdigest()
+                zotus_fh.write('>%s\n%s\n' % (seq_id, seq))
+
+
+def main():
+    max_amplicons = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    sizes = []
+    n = 12500
+    while n <= max_amplicons:
+        sizes.append(n)
+        n *= 2
+    print("%-12s %10s %14s" % ('amplicons', 'time_s', 'us_per_amp'))
+    for n_amplicons in sizes:
+        with tempfile.TemporaryDirectory() as wd:
+            make_amplicons(wd, n_amplicons)
+            start = time.perf_counter()
+            _split_zotu_chimera(wd, use_vsearch=True, verbose=False)
+            elapsed = time.perf_counter() - start
+        print("%-12d %10.2f %14.2f" % (
+            n_amplicons, elapsed, elapsed / n_amplicons * 1e6))
+
+
+if __name__ == '__main__':
+    main()
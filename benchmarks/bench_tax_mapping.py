@@ -0,0 +1,51 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2024, magicprotoss;biodps.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+# Wall time of the qiime2 -> usearch taxonomy conversion used by sintax on a
+# synthetic reference taxonomy.
+# usage: python benchmarks/bench_tax_mapping.py [n_rows]
+
+import sys
+import time
+import random
+
+import pandas as pd
+
+from q2_usearch._sintax import _make_tmp_tax_mapping_df
+
+
+def make_taxonomy(n_rows, seed=42):
+    # a tree with a few hundred thousand distinct labels, like SILVA
+    rng = random.Random(seed)
+    fan_out = [3, 60, 150, 400, 1200, 6000, 30000]
+    names = [['%s__Taxon_%d%s' % (rank, i, ' sp.' if rank == 's' else '')
+              for i in range(n)] for rank, n in zip('dpcofgs', fan_out)]
+    taxa = []
+    for _ in range(n_rows):
+        lineage = [rng.choice(level) for level in names]
+        # some lineages stop early, like unclassified references do
+        taxa.append('; '.join(lineage[:rng.choice([4, 5, 6, 7, 7, 7])]))
+    index = pd.Index(['ref%d' % i for i in range(n_rows)], name='Feature ID')
+    return pd.DataFrame({'Taxon': taxa}, index=index)
+
+
+def main():
+    n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    tax_df = make_taxonomy(n_rows)
+    labels = tax_df['Taxon'].str.split(';', expand=True).stack().str.strip()
+    print("input: %d rows, %d distinct labels" % (n_rows, labels.nunique()))
+    start = time.perf_counter()
+    taxa_map_df = _make_tmp_tax_mapping_df(tax_df)
+    elapsed = time.perf_counter() - start
+    print("_make_tmp_tax_mapping_df: %.2fs (%.2f us per row)" % (
+        elapsed, elapsed / n_rows * 1e6))
+    print(taxa_map_df['usearch_tax'].iloc[0])
+
+
+if __name__ == '__main__':
+    main()
@@ -7,7 +7,7 @@
 # ----------------------------------------------------------------------------
 
 from ._illumina_pipeline import denoise_no_primer_pooled, cluster_no_primer_pooled, denoise_then_cluster_no_primer_pooled
-from ._sintax import sintax
+from ._sintax import sintax, build_sintax_db, sintax_prebuilt
 
 # modified from q2-vsearch
 from ._merge_pairs import merge_pairs
@@ -18,4 +18,5 @@ __version__ = get_versions()["version"]
 del get_versions
 
 __all__ = ['denoise_no_primer_pooled', 'cluster_no_primer_pooled',
-           'denoise_then_cluster_no_primer_pooled', 'merge_pairs', 'sintax']
+           'denoise_then_cluster_no_primer_pooled', 'merge_pairs', 'sintax',
+           'build_sintax_db', 'sintax_prebuilt']
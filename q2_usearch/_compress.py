@@ -0,0 +1,90 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2024, magicprotoss;biodps.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import io
+import gzip
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# All gzip outputs of the plug-in go through gzip_writer(), so the level and
+# the number of compression threads are picked in one place.
+# gzip.open() defaults to level 9 which is painfully slow for fastq and gains
+# very little over 6 (the gzip cli default), hence the default here.
+
+DEFAULT_COMPRESSION_LEVEL = 6
+
+# size of the chunks handed to the compression threads, large enough for the
+# per member overhead (~20 bytes + a fresh dictionary) to be negligible
+_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def gzip_writer(fp, level=DEFAULT_COMPRESSION_LEVEL, threads=1):
+    """Open ``fp`` for writing gzip compressed bytes.
+
+    With a single thread this is plain ``gzip.open``. With more threads the
+    input is cut into blocks that are compressed concurrently (pigz-style)
+    and written as consecutive gzip members, which every gzip reader
+    (including python's gzip module and q2-types) decompresses transparently.
+    """
+    if threads > 1:
+        return ParallelGzipWriter(fp, level=level, threads=threads)
+    return gzip.open(fp, 'wb', compresslevel=level)
+
+
+def _compress_block(block, level):
+    # wbits=31 makes zlib write a complete gzip member (header + trailer)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(block) + compressor.flush()
+
+
+class ParallelGzipWriter(io.RawIOBase):
+    """Block-parallel gzip writer, zlib releases the GIL while compressing."""
+
+    def __init__(self, fp, level=DEFAULT_COMPRESSION_LEVEL, threads=2,
+                 block_size=_BLOCK_SIZE):
+        super().__init__()
+        self._fh = open(fp, 'wb')
+        self._level = level
+        self._threads = threads
+        self._block_size = block_size
+        self._buffer = bytearray()
+        self._pending = deque()
+        self._executor = ThreadPoolExecutor(max_workers=threads)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self._block_size:
+            self._submit(bytes(self._buffer[:self._block_size]))
+            del self._buffer[:self._block_size]
+        return len(data)
+
+    def _submit(self, block):
+        self._pending.append(
+            self._executor.submit(_compress_block, block, self._level))
+        # keep a bounded number of blocks in flight, written in order
+        while len(self._pending) > 2 * self._threads:
+            self._fh.write(self._pending.popleft().result())
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            # an empty input still gets a valid (empty) gzip member
+            if self._buffer or (self._fh.tell() == 0 and not self._pending):
+                self._submit(bytes(self._buffer))
+                self._buffer.clear()
+            while self._pending:
+                self._fh.write(self._pending.popleft().result())
+        finally:
+            self._executor.shutdown()
+            self._fh.close()
+            super().close()
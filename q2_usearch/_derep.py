@@ -0,0 +1,207 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2024, magicprotoss;biodps.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import heapq
+import shutil
+import hashlib
+import tempfile
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from ._seqio import read_fasta, read_fasta_labels, write_fasta_record
+
+# In-process replacement for `usearch -fastx_uniques -sizeout`. Reads are
+# streamed, every unique sequence is stored once and its abundance kept in a
+# flat array, so memory grows with the number of uniques, not with the
+# number of reads.
+# Uniques are written as <label of first occurrence>;size=N, most abundant
+# first, ties in order of first occurrence.
+# For very large runs the reads can be hash-partitioned into shards by
+# sequence, every shard is dereplicated by its own process and the sorted
+# shard outputs are merged, the result is the same as with a single shard.
+
+_DEREP_BLOCK_SIZE = 8 * 1024 * 1024
+
+_RC_TABLE = bytes.maketrans(b'ACGTURYKMBDHVN', b'TGCAAYRMKVHDBN')
+
+
+def _digest(seq):
+    return hashlib.blake2b(seq, digest_size=16).digest()
+
+
+def _reverse_complement(seq):
+    return seq.translate(_RC_TABLE)[::-1]
+
+
+class UniqueTable:
+    """Abundance table of unique sequences, in order of first occurrence."""
+
+    def __init__(self, strand="plus"):
+        self.both_strands = strand == "both"
+        self.index = {}
+        self.sizes = array('Q')
+        self.labels = []
+        self.seqs = []
+        # index of the read each unique was first seen at
+        self.firsts = array('Q')
+        self.reads = 0
+
+    def add(self, label, seq, size=1, first=None):
+        seq = seq.upper()
+        # the index is keyed by the very bytes object kept in seqs, the
+        # sequence is not stored twice
+        i = self.index.get(seq)
+        if i is None and self.both_strands:
+            i = self.index.get(_reverse_complement(seq))
+        if i is None:
+            self.index[seq] = len(self.sizes)
+            self.sizes.append(size)
+            self.labels.append(label)
+            self.seqs.append(seq)
+            self.firsts.append(self.reads if first is None else first)
+        else:
+            self.sizes[i] += size
+        self.reads += 1
+
+    def size_array(self):
+        return np.array(self.sizes, dtype=np.int64)
+
+    def sorted_order(self):
+        # stable sort keeps ties in order of first occurrence
+        return np.argsort(-self.size_array(), kind='stable')
+
+    def write(self, out_fh, min_unique_size=None):
+        for i in self.sorted_order().tolist():
+            size = self.sizes[i]
+            if min_unique_size is not None and size < min_unique_size:
+                # sorted by size, everything below is smaller still
+                break
+            out_fh.write(b'>%s;size=%d\n%s\n' % (self.labels[i], size, self.seqs[i]))
+
+    def stats(self):
+        # total reads, unique sequences, singletons
+        sizes = self.size_array()
+        return int(sizes.sum()), len(sizes), int((sizes == 1).sum())
+
+
+def dereplicate_fasta(input_fp, output_fp, strand="plus", min_unique_size=None,
+                      shards=1):
+    """Dereplicate a fasta file into size annotated, abundance sorted uniques.
+
+    Returns the number of input reads, unique sequences and singletons,
+    counted before ``min_unique_size`` is applied (same as usearch).
+    With ``shards`` > 1 the work (and the memory) is split over that many
+    worker processes, the output doesn't change.
+    """
+    if shards > 1:
+        return _dereplicate_sharded(
+            input_fp, output_fp, strand, min_unique_size, shards)
+    table = UniqueTable(strand)
+    for label, seq in read_fasta(input_fp):
+        table.add(label, seq)
+    with open(output_fp, 'wb') as out_fh:
+        table.write(out_fh, min_unique_size)
+    return table.stats()
+
+
+def _shard_of(seq, both_strands, shards):
+    # every orientation of a sequence has to land in the same shard
+    if both_strands:
+        seq = min(seq, _reverse_complement(seq))
+    return int.from_bytes(_digest(seq)[:8], 'little') % shards
+
+
+def _dereplicate_sharded(input_fp, output_fp, strand, min_unique_size, shards):
+    shard_dir = tempfile.mkdtemp(
+        prefix='derep_shards_', dir=os.path.dirname(os.path.abspath(output_fp)))
+    try:
+        # partition, every read is written as <read index>\t<seq>\t<label>
+        # so the workers know where it was first seen in the whole input.
+        # The label goes last and is split off with a bounded split, so tabs
+        # in labels come through unchanged
+        shard_fps = [os.path.join(shard_dir, '%d.tsv' % n) for n in range(shards)]
+        shard_fhs = [open(fp, 'wb', buffering=_DEREP_BLOCK_SIZE // shards)
+                     for fp in shard_fps]
+        try:
+            for i, (label, seq) in enumerate(read_fasta(input_fp)):
+                seq = seq.upper()
+                shard_fhs[_shard_of(seq, strand == "both", shards)].write(
+                    b'%d\t%s\t%s\n' % (i, seq, label))
+        finally:
+            for fh in shard_fhs:
+                fh.close()
+
+        sorted_fps = [fp + '.sorted' for fp in shard_fps]
+        with ProcessPoolExecutor(max_workers=shards) as executor:
+            shard_stats = list(executor.map(
+                _dereplicate_shard, shard_fps, sorted_fps, [strand] * shards))
+
+        # shard outputs are sorted by (-size, first seen), so are the merged
+        # uniques, same order as a single table would give
+        sorted_fhs = [open(fp, 'rb') for fp in sorted_fps]
+        try:
+            with open(output_fp, 'wb') as out_fh:
+                for size, _, label, seq in heapq.merge(
+                        *[map(_parse_sorted_line, fh) for fh in sorted_fhs],
+                        key=lambda unique: (-unique[0], unique[1])):
+                    if min_unique_size is not None and size < min_unique_size:
+                        break
+                    out_fh.write(b'>%s;size=%d\n%s\n' % (label, size, seq))
+        finally:
+            for fh in sorted_fhs:
+                fh.close()
+    finally:
+        shutil.rmtree(shard_dir)
+
+    total, uniques, singletons = (sum(counts) for counts in zip(*shard_stats))
+    return total, uniques, singletons
+
+
+def _dereplicate_shard(shard_fp, sorted_fp, strand):
+    # runs in a worker process, only this shard's uniques are held in memory
+    table = UniqueTable(strand)
+    with open(shard_fp, 'rb') as fh:
+        for line in fh:
+            first, seq, label = line.rstrip(b'\n').split(b'\t', 2)
+            table.add(label, seq, first=int(first))
+    os.remove(shard_fp)
+    with open(sorted_fp, 'wb') as out_fh:
+        for i in table.sorted_order().tolist():
+            out_fh.write(b'%d\t%d\t%s\t%s\n' % (
+                table.sizes[i], table.firsts[i], table.seqs[i], table.labels[i]))
+    return table.stats()
+
+
+def _parse_sorted_line(line):
+    size, first, seq, label = line.rstrip(b'\n').split(b'\t', 3)
+    return int(size), int(first), label, seq
+
+
+def size_annotation_stats(fasta_fp):
+    """Total reads, uniques and singletons from a ``;size=N`` annotated fasta."""
+    sizes = np.array([_parse_size(label) for label in read_fasta_labels(fasta_fp)],
+                     dtype=np.int64)
+    return int(sizes.sum()), len(sizes), int((sizes == 1).sum())
+
+
+def filter_by_size(input_fp, output_fp, min_size):
+    """Copy the ``;size=N`` annotated records with N >= ``min_size``."""
+    with open(output_fp, 'wb') as out_fh:
+        for label, seq in read_fasta(input_fp):
+            if _parse_size(label) >= min_size:
+                write_fasta_record(out_fh, label, seq)
+
+
+def _parse_size(label):
+    for field in label.split(b';'):
+        if field.startswith(b'size='):
+            return int(field[5:])
+    return 1
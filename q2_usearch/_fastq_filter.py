@@ -0,0 +1,194 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2024, magicprotoss;biodps.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import re
+import gzip
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# In-process replacement for `usearch -fastq_filter`, only the options the
+# pooled pipelines use are supported: stripleft, trunclen, minlen, maxns and
+# maxee. Reads are parsed in batches, the per base error probabilities are
+# looked up from a table and summed with a cumulative sum over the whole
+# batch, so there is no python level loop over bases.
+
+_FILTER_BATCH_SIZE = 16 * 1024 * 1024
+
+# the sample prefix of a relabeled read label, i.e. "S1" in "@S1.123"
+_SAMPLE_PREFIX_RE = re.compile(rb'[^.\s]*')
+
+
+def _error_prob_lut(phred_offset=33):
+    # P(error) = 10 ^ (-Q / 10), chars below the offset are treated as Q0
+    q = np.clip(np.arange(256) - phred_offset, 0, None)
+    return 10.0 ** (-q / 10.0)
+
+
+def _cut_at_record_boundary(buf):
+    # returns the length of the leading complete 4-line records in buf
+    lines = buf.split(b'\n')
+    complete = (len(lines) - 1) // 4 * 4
+    return sum(map(len, lines[:complete])) + complete
+
+
+def _filter_batch(batch, opts, first_read=0):
+    # batch holds whole 4-line fastq records, first_read is the number of
+    # reads before this batch (for relabeling)
+    # returns passing reads as fasta bytes, the per sample pass counts and
+    # the number of reads in the batch
+    lines = batch.split(b'\n')
+    if lines and lines[-1] == b'':
+        lines.pop()
+    if len(lines) % 4 != 0:
+        raise ValueError("Truncated fastq record, only 4-line fastq records "
+                         "are supported")
+    headers = lines[0::4]
+    seqs = lines[1::4]
+    quals = lines[3::4]
+    n = len(headers)
+    if n == 0:
+        return b'', Counter(), 0
+
+    lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=n)
+    qual_lengths = np.fromiter(map(len, quals), dtype=np.int64, count=n)
+    if not np.array_equal(lengths, qual_lengths):
+        raise ValueError("Sequence and quality lengths differ in fastq input")
+
+    stripleft = opts['stripleft']
+    start = np.minimum(stripleft, lengths)
+    if opts['trunclen']:
+        end = np.full(n, stripleft + opts['trunclen'])
+        # reads shorter than trunclen are discarded
+        keep = lengths >= end
+        end = np.minimum(end, lengths)
+    else:
+        end = lengths
+        keep = end > start
+    if opts['minlen'] is not None:
+        keep &= (end - start) >= opts['minlen']
+
+    # window sums via cumulative sums over the concatenated batch
+    offsets = np.zeros(n, dtype=np.int64)
+    np.cumsum(lengths[:-1], out=offsets[1:])
+    first = offsets + start
+    last = offsets + end
+    if opts['maxee'] is not None:
+        qual_buf = np.frombuffer(b''.join(quals), dtype=np.uint8)
+        err_cs = np.zeros(len(qual_buf) + 1)
+        np.cumsum(opts['lut'][qual_buf], out=err_cs[1:])
+        keep &= (err_cs[last] - err_cs[first]) <= opts['maxee']
+    if opts['maxns'] is not None:
+        seq_buf = np.frombuffer(b''.join(seqs), dtype=np.uint8)
+        n_cs = np.zeros(len(seq_buf) + 1, dtype=np.int64)
+        np.cumsum((seq_buf == ord('N')) | (seq_buf == ord('n')), out=n_cs[1:])
+        keep &= (n_cs[last] - n_cs[first]) <= opts['maxns']
+
+    passed = np.flatnonzero(keep).tolist()
+    start = start.tolist()
+    end = end.tolist()
+    if opts['relabel'] is not None:
+        # reads keep their number among all reads of the sample, same as
+        # relabeling first and filtering later
+        fasta = b''.join([
+            b'>%s%d\n%s\n' % (
+                opts['relabel'], first_read + i + 1, seqs[i][start[i]:end[i]])
+            for i in passed])
+        counts = Counter({opts['relabel'][:-1]: len(passed)})
+    else:
+        fasta = b''.join([
+            b'>%s\n%s\n' % (headers[i][1:], seqs[i][start[i]:end[i]]) for i in passed])
+        counts = Counter(
+            [_SAMPLE_PREFIX_RE.match(headers[i], 1).group(0) for i in passed])
+    return fasta, counts, n
+
+
+def filter_fastq(input_fp, output_fp, stripleft=0, trunclen=0, minlen=None,
+                 maxee=None, maxns=None, phred_offset=33, threads=1):
+    """Quality filter a fastq file into a fasta file.
+
+    Mirrors ``usearch -fastq_filter`` with ``-fastq_stripleft``,
+    ``-fastq_trunclen``, ``-fastq_minlen``, ``-fastq_maxee`` and
+    ``-fastq_maxns``. Returns a Counter of passing reads per sample, keyed by
+    the read label up to the first dot.
+    """
+    opts = _filter_opts(stripleft, trunclen, minlen, maxee, maxns, phred_offset)
+    counts = Counter()
+    with open(input_fp, 'rb') as in_fh, open(output_fp, 'wb') as out_fh:
+        if threads > 1:
+            # batches are filtered by a pool of workers and written back in
+            # order, so the output doesn't depend on the number of threads
+            with ProcessPoolExecutor(max_workers=threads) as executor:
+                pending = deque()
+                for batch in _iter_batches(in_fh):
+                    pending.append(executor.submit(_filter_batch, batch, opts))
+                    while len(pending) > 2 * threads:
+                        _collect(pending.popleft().result(), out_fh, counts)
+                while pending:
+                    _collect(pending.popleft().result(), out_fh, counts)
+        else:
+            for batch in _iter_batches(in_fh):
+                _collect(_filter_batch(batch, opts), out_fh, counts)
+    return counts
+
+
+def filter_fastq_sample(input_fp, output_fh, sample_id, stripleft=0, trunclen=0,
+                        minlen=None, maxee=None, maxns=None, phred_offset=33):
+    """Relabel and quality filter one gzipped sample in a single pass.
+
+    Passing reads are appended to ``output_fh`` as fasta, labelled
+    ``<sample_id>.<n>`` where n is the number of the read in the input.
+    Returns the number of input reads and the number of passing reads.
+    """
+    opts = _filter_opts(stripleft, trunclen, minlen, maxee, maxns, phred_offset,
+                        relabel=(sample_id + '.').encode('ascii'))
+    reads = 0
+    passed = 0
+    with gzip.open(input_fp, 'rb') as in_fh:
+        for batch in _iter_batches(in_fh):
+            fasta, counts, n = _filter_batch(batch, opts, reads)
+            output_fh.write(fasta)
+            passed += sum(counts.values())
+            reads += n
+    return reads, passed
+
+
+def _filter_opts(stripleft, trunclen, minlen, maxee, maxns, phred_offset,
+                 relabel=None):
+    return {
+        'stripleft': stripleft,
+        'trunclen': trunclen,
+        'minlen': minlen,
+        'maxee': maxee,
+        'maxns': maxns,
+        'lut': _error_prob_lut(phred_offset),
+        'relabel': relabel,
+    }
+
+
+def _iter_batches(fh):
+    tail = b''
+    while True:
+        block = fh.read(_FILTER_BATCH_SIZE)
+        if not block:
+            break
+        buf = tail + block
+        cut = _cut_at_record_boundary(buf)
+        tail = buf[cut:]
+        if cut:
+            yield buf[:cut]
+    if tail.strip():
+        # no trailing newline, _filter_batch checks it is a whole record
+        yield tail
+
+
+def _collect(result, out_fh, counts):
+    fasta, batch_counts, _ = result
+    out_fh.write(fasta)
+    counts.update(batch_counts)
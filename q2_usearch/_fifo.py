@@ -0,0 +1,131 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2024, magicprotoss;biodps.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import gzip
+import threading
+
+from ._compress import gzip_writer, DEFAULT_COMPRESSION_LEVEL
+
+# usearch reads its input and writes its output sequentially, so instead of
+# gunzipping every .fastq.gz into the working dir (and gzipping the results
+# afterwards) we hand it named pipes and (de)compress on the other end from
+# background threads. Compressed files are read or written once and the
+# uncompressed copies never touch the disk.
+
+_FIFO_BLOCK_SIZE = 1024 * 1024
+
+
+class _FifoThread(threading.Thread):
+    # mkfifo on init, start on enter, join and clean up on exit
+    # subclasses implement _pump() and open the pipe with _open_fifo()
+
+    def __init__(self, fifo_fp):
+        super().__init__(daemon=True)
+        self.fifo_fp = fifo_fp
+        self.lines = 0
+        self.error = None
+        # set once the thread is past open(), whatever the outcome
+        self._opened = threading.Event()
+        os.mkfifo(fifo_fp)
+
+    def run(self):
+        try:
+            self._pump()
+        except BrokenPipeError:
+            # the other end went away early, it reports its own failure
+            pass
+        except Exception as e:
+            self.error = e
+        finally:
+            self._opened.set()
+
+    def _open_fifo(self, mode):
+        try:
+            return open(self.fifo_fp, mode)
+        finally:
+            self._opened.set()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        # don't let a pipe error mask the one raised by the command
+        if exc_type is None and self.error is not None:
+            raise self.error
+
+    def close(self):
+        if self.is_alive():
+            # the command may never have opened its end of the pipe (i.e. it
+            # crashed early, or simply had nothing to write), and the thread
+            # may not even have reached its own open() yet. O_RDWR opens a
+            # fifo without blocking and without waiting for the other end,
+            # holding it lets the thread's open() through whenever it gets
+            # there. It is dropped as soon as the thread is past open(): a
+            # reading thread then sees an EOF, a writing one a broken pipe
+            fd = os.open(self.fifo_fp, os.O_RDWR | os.O_NONBLOCK)
+            try:
+                self._opened.wait()
+            finally:
+                os.close(fd)
+        self.join()
+        if os.path.exists(self.fifo_fp):
+            os.remove(self.fifo_fp)
+
+
+class GunzipFifo(_FifoThread):
+    """Stream a gzipped file into a named pipe until the reader is done.
+
+    Use as a context manager around the command that reads ``fifo_fp``.
+    The number of newlines streamed is kept in ``lines``, so fastq read
+    counts come for free.
+    """
+
+    def __init__(self, gzipped_fp, fifo_fp):
+        super().__init__(fifo_fp)
+        self.gzipped_fp = gzipped_fp
+
+    def _pump(self):
+        # open the pipe first, if the gzip file is broken the reader
+        # still gets an EOF instead of hanging on open()
+        with self._open_fifo('wb') as f_out:
+            with gzip.open(self.gzipped_fp, 'rb') as f_in:
+                while True:
+                    block = f_in.read(_FIFO_BLOCK_SIZE)
+                    if not block:
+                        break
+                    self.lines += block.count(b'\n')
+                    f_out.write(block)
+
+
+class GzipFifo(_FifoThread):
+    """Compress everything written into a named pipe to ``gzipped_fp``.
+
+    Use as a context manager around the command that writes ``fifo_fp``.
+    If the command never opens the pipe an empty gzip file is written,
+    same as compressing an empty output file.
+    """
+
+    def __init__(self, fifo_fp, gzipped_fp,
+                 level=DEFAULT_COMPRESSION_LEVEL, threads=1):
+        super().__init__(fifo_fp)
+        self.gzipped_fp = gzipped_fp
+        self.level = level
+        self.threads = threads
+
+    def _pump(self):
+        with self._open_fifo('rb') as f_in:
+            with gzip_writer(self.gzipped_fp, self.level, self.threads) as f_out:
+                while True:
+                    block = f_in.read(_FIFO_BLOCK_SIZE)
+                    if not block:
+                        break
+                    self.lines += block.count(b'\n')
+                    f_out.write(block)
@@ -8,7 +8,9 @@
 
 # register usearch_stats_format
 
-from qiime2.plugin import SemanticType, model
+import os
+
+from qiime2.plugin import SemanticType, ValidationError, model
 from q2_types.sample_data import SampleData
 
 USEARCHStats = SemanticType('USEARCHStats', variant_of=SampleData.field['type'])
@@ -19,3 +21,26 @@ class USEARCHStatsFormat(model.TextFileFormat):
 
 USEARCHStatsDirFmt = model.SingleFileDirectoryFormat(
     'USEARCHStatsDirFmt', 'stats.tsv', USEARCHStatsFormat)
+
+
+# register sintax reference db format
+# a usearch -makeudb_sintax index plus the table mapping the usearch style
+# taxa back to the original qiime2 taxonomy strings
+
+USEARCHSintaxDB = SemanticType('USEARCHSintaxDB')
+
+class USEARCHUDBFormat(model.BinaryFileFormat):
+    def _validate_(self, level):
+        if os.path.getsize(str(self)) == 0:
+            raise ValidationError('The udb file is empty.')
+
+class USEARCHTaxaMapFormat(model.TextFileFormat):
+    def _validate_(self, level):
+        with self.open() as fh:
+            header = fh.readline().rstrip('\n').split('\t')
+        if 'usearch_tax' not in header:
+            raise ValidationError('The taxa map has no usearch_tax column.')
+
+class USEARCHSintaxDBDirFmt(model.DirectoryFormat):
+    udb = model.File('ref_seqs_tax.udb', format=USEARCHUDBFormat)
+    taxa_map = model.File('taxa_map.tsv', format=USEARCHTaxaMapFormat)
@@ -9,40 +9,39 @@
 import qiime2
 import pandas as pd
 import numpy as np
-import subprocess
 import tempfile
 import skbio
 from q2_types.per_sample_sequences import SingleLanePerSampleSingleEndFastqDirFmt
+from q2_types.feature_data import DNAFASTAFormat
 from glob import glob
 import shutil
 import gzip
 import os
 import re
-import time
 import hashlib
 import biom
-
-
-def py_to_cli_interface(cmd, verbose=True):
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+
+from ._fifo import GunzipFifo
+from ._runner import run_command
+from ._profile import StageProfiler
+from ._fastq_filter import filter_fastq, filter_fastq_sample
+from ._derep import dereplicate_fasta, size_annotation_stats, filter_by_size
+from ._otutab import read_otutab
+from ._seqio import (read_fasta, read_fasta_labels, write_fasta_record,
+                     write_fasta_records, count_fasta_records, fasta_is_empty)
+
+
+def py_to_cli_interface(cmd, verbose=True, *, log_dir, step=None):
+    # the command's stdout/stderr logs go to log_dir, which is always the
+    # working dir of the run so they are cleaned up along with it
     try:
         cmd_log_index = cmd.index("-log") + 1
         log_fp = cmd[cmd_log_index]
     except ValueError:
         log_fp = ""
-    if verbose:
-        print("Running external command line application. This may print "
-              "messages to stdout and/or stderr.")
-        print("The command(s) being run are below. These commands cannot "
-              "be manually re-run as they will depend on temporary files that "
-              "no longer exist.")
-        print("\nCommand:", end=' ')
-        print(" ".join(cmd), end='\n\n')
-        time.sleep(1)
-        subprocess.run(cmd, check=True)
-    else:
-        time.sleep(1)
-        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL,
-                       stderr=subprocess.DEVNULL)
+    run_command(cmd, log_dir, step=step, verbose=verbose)
     if os.path.exists(log_fp):
         with open(log_fp, "rt") as f:
             log_lines_lst = [line.replace("\n", "").strip()
@@ -53,36 +52,128 @@ def py_to_cli_interface(cmd, verbose=True):
     return log_lines_lst
 
 
+_RELABEL_BLOCK_SIZE = 8 * 1024 * 1024
+
+
+def _relabel_fastq(input_fp, pooled_seqs_fh, sample_id):
+    # stream a gzipped fastq into the pooled file with every header replaced
+    # by <sample_id>.<n> (same as seqkit replace -p .+ -r <sample_id>.{nr})
+    # the input is read once in large blocks, returns the number of reads
+    prefix = ('@' + sample_id + '.').encode('ascii')
+    reads = 0
+    tail = b''
+    with gzip.open(input_fp, 'rb') as fh:
+        while True:
+            block = fh.read(_RELABEL_BLOCK_SIZE)
+            if not block:
+                break
+            lines = (tail + block).split(b'\n')
+            # the last line is always incomplete (or empty), hold back the
+            # unfinished record for the next block
+            complete = (len(lines) - 1) // 4 * 4
+            tail = b'\n'.join(lines[complete:])
+            reads = _write_relabeled_records(
+                lines[:complete], pooled_seqs_fh, prefix, reads, input_fp)
+    # whatever is left must be whole records, i.e. no trailing newline
+    lines = tail.split(b'\n')
+    while lines and lines[-1] == b'':
+        lines.pop()
+    if len(lines) % 4 != 0:
+        raise ValueError("Truncated fastq record at the end of " + input_fp)
+    return _write_relabeled_records(lines, pooled_seqs_fh, prefix, reads, input_fp)
+
+
+def _write_relabeled_records(lines, out_fh, prefix, reads, input_fp):
+    headers = lines[0::4]
+    if not all(header.startswith(b'@') for header in headers):
+        raise ValueError("Malformed fastq record in " + input_fp +
+                         ", only 4-line fastq records are supported")
+    out_fh.write(b''.join([
+        b'%s%d\n%s\n+\n%s\n' % (prefix, n, seq, qual)
+        for n, seq, qual in zip(
+            range(reads + 1, reads + len(headers) + 1), lines[1::4], lines[3::4])
+    ]))
+    return reads + len(headers)
+
+
+def _relabel_fastq_to_chunk(input_fp, chunk_fp, sample_id):
+    # runs in a worker process
+    with open(chunk_fp, 'wb') as chunk_fh:
+        return _relabel_fastq(input_fp, chunk_fh, sample_id)
+
+
+def _append_chunk(pending_chunk, pooled_seqs_fh, stats_df):
+    index, chunk_fp, future = pending_chunk
+    stats_df.loc[index, 'prior_to_maxee_filt'] = future.result()
+    with open(chunk_fp, 'rb') as chunk_fh:
+        shutil.copyfileobj(chunk_fh, pooled_seqs_fh, _RELABEL_BLOCK_SIZE)
+    os.remove(chunk_fp)
+
+
+def _fix_sample_ids(input_manifest_df):
+    # usearch only accepts [a-zA-Z0-9_] in sample identifiers, fall back to
+    # S1, S2 ... (in manifest order) if any sample id doesn't fit
+    use_temp_sample_ids = not all(
+        re.match(r'^[a-zA-Z0-9_]+$', sample_id)
+        for sample_id in input_manifest_df.index.to_list())
+    sample_ids = {}
+    for sample_num, index in enumerate(input_manifest_df.index, 1):
+        if use_temp_sample_ids:
+            sample_ids[index] = "S" + str(sample_num)
+        else:
+            sample_ids[index] = str(index)
+    return sample_ids, use_temp_sample_ids
+
+
+def _swap_to_fixed_ids(stats_df, sample_ids):
+    # index stats_df by the ids used during the run, keep the original ones
+    # around so they can be swapped back at the end
+    stats_df['fixed_sample_id'] = pd.Series(sample_ids)
+    stats_df.reset_index(inplace=True)
+    stats_df.rename(columns={'sample-id': 'original_sample_id'}, inplace=True)
+    stats_df.set_index('fixed_sample_id', inplace=True)
+    stats_df.index.name = "sample-id"
+    return stats_df
+
+
+def _get_phred_offset(demultiplexed_sequences_dirpath):
+    with open(os.path.join(demultiplexed_sequences_dirpath, 'metadata.yml')) as f:
+        return int(str(f.readlines()[0]).split(": ")[1])
+
+
+def _resolve_threads(threads):
+    if threads == "auto":
+        return os.cpu_count() or 1
+    return int(threads)
+
+
+def _get_pool_jobs(threads, n_samples):
+    return max(1, min(_resolve_threads(threads), n_samples))
+
+
 # Pool All Samples into a single fastq
 
-def _pool_samples(demultiplexed_sequences_dirpath, working_dir, keep_annotations: bool = False, use_vsearch: bool = False, debug = False, verbose: bool = True):
+def _pool_samples(demultiplexed_sequences_dirpath, working_dir,
+                  keep_annotations: bool = False, use_vsearch: bool = False,
+                  threads="auto", debug=False, verbose: bool = True):
     input_manifest_df = pd.read_csv(os.path.join(
         demultiplexed_sequences_dirpath, 'MANIFEST'), index_col=0, comment='#')
-        
-    use_temp_sample_ids = False
-        
+
     # check if all input sample_ids meet usearch sample identifier requirements
-    if len(input_manifest_df) != len([ sample_id for sample_id in input_manifest_df.index.to_list() if re.match(r'^[a-zA-Z0-9_]+$', sample_id) ]):
-        use_temp_sample_ids = True
-        pipeout_denoise_stats_df = pd.DataFrame(
-            index=input_manifest_df.index, columns=['prior_to_maxee_filt', 'fixed_sample_id'])
-    else:
-        pipeout_denoise_stats_df = pd.DataFrame(
-            index=input_manifest_df.index, columns=['prior_to_maxee_filt'])
-    unzipped_seqs_dirpath = os.path.join(working_dir, "unzipped_seqs")
-    os.mkdir(unzipped_seqs_dirpath)
+    # and fix the temp ids up front, so workers can't shuffle them
+    sample_ids, use_temp_sample_ids = _fix_sample_ids(input_manifest_df)
+
+    pipeout_denoise_stats_df = pd.DataFrame(
+        index=input_manifest_df.index, columns=['prior_to_maxee_filt'])
     relabed_seqs_dirpath = os.path.join(working_dir, "relabeled_seqs")
     os.mkdir(relabed_seqs_dirpath)
-    seqs_stats_dfs_dirpath = os.path.join(working_dir, "seqs_stats_dfs")
-    os.mkdir(seqs_stats_dfs_dirpath)
     pooled_seqs_fp = os.path.join(working_dir, "merged.fastq")
     
     if debug:
         # just keep this part for debugging purpose
         # not sure if it's necessary
         # any one to use usearch to process og data?
-        with open(os.path.join(demultiplexed_sequences_dirpath, 'metadata.yml')) as f:
-            phred_offset = int(str(f.readlines()[0]).split(": ")[1])
+        phred_offset = _get_phred_offset(demultiplexed_sequences_dirpath)
         if phred_offset == 33:
             variant = "illumina1.8"
         elif phred_offset == 64:
@@ -94,16 +185,15 @@ def _pool_samples(demultiplexed_sequences_dirpath, working_dir, keep_annotations
             else:
                 print("Adding sample-id to input seqs identifiers, this will take a while...\n")
     
+        if not use_vsearch:
+            # named pipes usearch reads the samples from
+            unzipped_seqs_dirpath = os.path.join(working_dir, "unzipped_seqs")
+            os.mkdir(unzipped_seqs_dirpath)
+
         with open(pooled_seqs_fp, 'wt') as pooled_seqs_fh:
-            sample_num = 1
             for index, row in input_manifest_df.iterrows():
-                if use_temp_sample_ids:
-                    sample_id = "S" + str(sample_num)
-                else:
-                    sample_id = str(index)
+                sample_id = sample_ids[index]
                 fn = str(row['filename'])
-                gzip_reader = gzip.open(
-                    os.path.join(demultiplexed_sequences_dirpath, fn), 'rt')
     
                 if verbose:
                     if use_temp_sample_ids:
@@ -114,38 +204,33 @@ def _pool_samples(demultiplexed_sequences_dirpath, working_dir, keep_annotations
     
                 # Could not find -fastx_relabel equivalent in vsearch
                 if use_vsearch:
-                    dna_seqs_gen = skbio.io.registry.read(
-                        gzip_reader, format="fastq", verify=True, variant=variant)
-                # skbio's fastq writer is way too slow
-                    i = 0
-                    for seq in dna_seqs_gen:
-                        i = i + 1
-                        seq.metadata["id"] = sample_id + "." + str(i)
-                        if not keep_annotations:
-                            seq.metadata["description"] = ""
-                        else:
-                            seq.metadata["description"] = seq.metadata['description'].replace(
-                                "\t", " ")
-                        # pooled seqs use 1.8 encoding
-                        seq.write(pooled_seqs_fh, format="fastq", variant="illumina1.8")
+                    # skbio's fastq writer is way too slow
+                    with gzip.open(os.path.join(demultiplexed_sequences_dirpath, fn),
+                                   'rt') as gzip_reader:
+                        dna_seqs_gen = skbio.io.registry.read(
+                            gzip_reader, format="fastq", verify=True, variant=variant)
+                        i = 0
+                        for seq in dna_seqs_gen:
+                            i = i + 1
+                            seq.metadata["id"] = sample_id + "." + str(i)
+                            if not keep_annotations:
+                                seq.metadata["description"] = ""
+                            else:
+                                seq.metadata["description"] = seq.metadata[
+                                    'description'].replace("\t", " ")
+                            # pooled seqs use 1.8 encoding
+                            seq.write(pooled_seqs_fh, format="fastq",
+                                      variant="illumina1.8")
     
                 # Usearch is much faster at relabeling seqs
                 else:
-    
+                    # usearch reads the input through a named pipe, no
+                    # uncompressed copy is written to the working dir
                     uzipped_seq_fp = os.path.join(
                         unzipped_seqs_dirpath, sample_id + ".fastq")
                     relabed_seq_fp = os.path.join(
                         relabed_seqs_dirpath, sample_id + ".fastq")
     
-                    with open(uzipped_seq_fp, 'wt') as f:
-                        f.write(gzip_reader.read())
-                        f.flush()
-    
-                    # get input seqs count
-                    dna_seqs_gen = skbio.io.registry.read(
-                        uzipped_seq_fp, format="fastq", verify=True, variant=variant)
-                    i = len([seq for seq in dna_seqs_gen])
-    
                     # build relab command
                     cmd = ["usearch",
                            "-fastx_relabel", uzipped_seq_fp,
@@ -153,9 +238,14 @@ def _pool_samples(demultiplexed_sequences_dirpath, working_dir, keep_annotations
                            "-fastqout", relabed_seq_fp
                            ]
     
-                    relab_log = py_to_cli_interface(cmd, False)
+                    with GunzipFifo(os.path.join(demultiplexed_sequences_dirpath, fn),
+                                    uzipped_seq_fp) as feeder:
+                        relab_log = py_to_cli_interface(
+                            cmd, False, log_dir=working_dir,
+                            step="usearch_fastx_relabel_" + sample_id)
     
-                    os.remove(uzipped_seq_fp)
+                    # get input seqs count, counted while streaming
+                    i = feeder.lines // 4
     
                     # merge all relabed seqs into one file
     
@@ -166,96 +256,160 @@ def _pool_samples(demultiplexed_sequences_dirpath, working_dir, keep_annotations
                 
                 # write input seqs count to stats_df
                 pipeout_denoise_stats_df.loc[index, 'prior_to_maxee_filt'] = i
-                
-                if use_temp_sample_ids:
-                    # keep track of samples
-                    pipeout_denoise_stats_df.loc[index, 'fixed_sample_id'] = sample_id
-                    sample_num = sample_num + 1
-                    
-            # finally swap the index to fixed ids
 
-            pipeout_denoise_stats_df.reset_index(inplace=True)
-            pipeout_denoise_stats_df.rename(
-                columns={'sample-id': 'original_sample_id'}, inplace=True)
-            pipeout_denoise_stats_df.set_index('fixed_sample_id', inplace=True)
-            pipeout_denoise_stats_df.index.name = "sample-id"
-                
     
-    # seqkit makes this go burrrrr......
+    # relabel and count in a single pass, no seqkit
     else:
         
         if verbose:
-            print("Adding sample-id to input seqs identifiers, seqkit makes things go burrrrrrrrrr...\n")
+            print("Adding sample-id to input seqs identifiers...\n")
+        
+        n_jobs = _get_pool_jobs(threads, len(input_manifest_df))
         
         with open(pooled_seqs_fp, 'wb') as pooled_seqs_fh:
             
-            sample_num = 1
+            if n_jobs == 1:
+                for index, row in input_manifest_df.iterrows():
+                    sample_id = sample_ids[index]
+                    input_fp = os.path.join(
+                        demultiplexed_sequences_dirpath, str(row['filename']))
+                    
+                    if verbose:
+                        if use_temp_sample_ids:
+                            print("Now Working on sample: " + str(index))
+                            print("Temporarily Relabeling this sample to: " + sample_id)
+                        else:
+                            print("Now Working on sample: " + sample_id)
+                    
+                    # append relabeled reads to pooled_seqs and count them on the way
+                    pipeout_denoise_stats_df.loc[index, 'prior_to_maxee_filt'] = (
+                        _relabel_fastq(input_fp, pooled_seqs_fh, sample_id))
             
-            for index, row in input_manifest_df.iterrows():
-                
-                if use_temp_sample_ids:
-                    sample_id = "S" + str(sample_num)
-                else:
-                    sample_id = str(index)
-                fn = str(row['filename'])
-                input_fp = os.path.join(demultiplexed_sequences_dirpath, fn)
-                relabed_seq_fp = os.path.join(relabed_seqs_dirpath, sample_id + ".fastq")
-                seqs_stats_df_fp = os.path.join(seqs_stats_dfs_dirpath, sample_id + "_stats.tsv")
-                
-                
+            else:
                 if verbose:
-                    if use_temp_sample_ids:
-                        print("Now Working on sample: " + str(index))
-                        print("Temporarily Relabeling this sample to: " + sample_id)
-                    else:
-                        print("Now Working on sample: " + sample_id)
-                
-                # build relabel command
-                relab_cmd = ["seqkit",
-                       "replace",
-                       "-i", input_fp,
-                       "-o", relabed_seq_fp,
-                       "-p", ".+",
-                       "-r", sample_id + ".{nr}"]
-                
-                silence = py_to_cli_interface(relab_cmd, verbose=False)
-                
-                # append to pooled_seqs and then del
-                with open(relabed_seq_fp, 'rb') as seq:
-                    shutil.copyfileobj(seq, pooled_seqs_fh)
-                
-                os.remove(relabed_seq_fp)
-                
-                # build count seq num command
-                stats_cmd = ["seqkit",
-                       "stats",
-                       "-T",
-                       input_fp,
-                       "-o", seqs_stats_df_fp]
-                       
-                silence = py_to_cli_interface(stats_cmd, verbose=False)
-                
-                # read stats df and append to pipeout_denoise_stats_df
-                stats_df = pd.read_csv(seqs_stats_df_fp, sep="\t", index_col=None, header=0)
-                pipeout_denoise_stats_df.loc[index, 'prior_to_maxee_filt'] = int(stats_df.at[0, 'num_seqs'])
+                    print("Relabeling " + str(len(input_manifest_df)) +
+                          " samples with " + str(n_jobs) + " workers...")
                 
+                # workers relabel into per sample chunks, which are appended
+                # to pooled_seqs in manifest order, so the pooled file is
+                # byte-identical to the one written by a single worker
+                with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                    pending = deque()
+                    for index, row in input_manifest_df.iterrows():
+                        sample_id = sample_ids[index]
+                        input_fp = os.path.join(
+                            demultiplexed_sequences_dirpath, str(row['filename']))
+                        chunk_fp = os.path.join(
+                            relabed_seqs_dirpath, sample_id + ".fastq")
+                        pending.append((index, chunk_fp, executor.submit(
+                            _relabel_fastq_to_chunk, input_fp, chunk_fp, sample_id)))
+                        # don't let finished chunks pile up in the working dir
+                        # while waiting on a slow sample
+                        while len(pending) > 2 * n_jobs:
+                            _append_chunk(pending.popleft(), pooled_seqs_fh,
+                                          pipeout_denoise_stats_df)
+                    while pending:
+                        _append_chunk(pending.popleft(), pooled_seqs_fh,
+                                      pipeout_denoise_stats_df)
+
+    # finally swap the index to fixed ids
+    if use_temp_sample_ids:
+        _swap_to_fixed_ids(pipeout_denoise_stats_df, sample_ids)
+
+    return pipeout_denoise_stats_df
+
+
+def _filter_sample_to_chunk(input_fp, chunk_fp, sample_id, filter_opts):
+    # runs in a worker process
+    with open(chunk_fp, 'wb') as chunk_fh:
+        return filter_fastq_sample(input_fp, chunk_fh, sample_id, **filter_opts)
+
+
+# per sample counts collected by _filter_and_pool_samples
+_FILTER_STATS_COLS = ['prior_to_maxee_filt', 'reads_passed_filter']
+
+
+def _append_filtered_chunk(pending_chunk, filtered_reads_fh, stats_df):
+    index, chunk_fp, future = pending_chunk
+    stats_df.loc[index, _FILTER_STATS_COLS] = future.result()
+    with open(chunk_fp, 'rb') as chunk_fh:
+        shutil.copyfileobj(chunk_fh, filtered_reads_fh, _RELABEL_BLOCK_SIZE)
+    os.remove(chunk_fp)
+
+
+# Filter each sample on its own, then pool the passing reads
+
+def _filter_and_pool_samples(demultiplexed_sequences_dirpath, working_dir,
+                             max_ee=1.0,
+                             trim_left=0,
+                             trunc_right=0,
+                             min_len=50,
+                             max_ns=None,
+                             threads="auto",
+                             verbose=True):
+    # same result as _pool_samples followed by _quality_control_cli with the
+    # native engine, but merged.fastq is never written: only reads passing
+    # the filter reach the working dir, as filtered.fasta
+    input_manifest_df = pd.read_csv(os.path.join(
+        demultiplexed_sequences_dirpath, 'MANIFEST'), index_col=0, comment='#')
+    sample_ids, use_temp_sample_ids = _fix_sample_ids(input_manifest_df)
+
+    stats_df = pd.DataFrame(
+        index=input_manifest_df.index, columns=_FILTER_STATS_COLS)
+    filtered_seqs_dirpath = os.path.join(working_dir, "filtered_seqs")
+    os.mkdir(filtered_seqs_dirpath)
+    filtered_reads_fp = os.path.join(working_dir, "filtered.fasta")
+
+    filter_opts = {
+        'stripleft': trim_left,
+        'trunclen': trunc_right,
+        'minlen': min_len,
+        'maxee': max_ee,
+        'maxns': max_ns,
+        'phred_offset': _get_phred_offset(demultiplexed_sequences_dirpath),
+    }
+    n_jobs = _get_pool_jobs(threads, len(input_manifest_df))
+
+    if verbose:
+        print("Now performing maxEE QC on each sample before pooling, with " +
+              str(n_jobs) + " worker(s)...\n")
+
+    with open(filtered_reads_fp, 'wb') as filtered_reads_fh:
+        if n_jobs == 1:
+            for index, row in input_manifest_df.iterrows():
+                if verbose:
+                    print("Now Working on sample: " + str(index))
+                input_fp = os.path.join(
+                    demultiplexed_sequences_dirpath, str(row['filename']))
+                stats_df.loc[index, _FILTER_STATS_COLS] = filter_fastq_sample(
+                    input_fp, filtered_reads_fh, sample_ids[index], **filter_opts)
+        else:
+            # same ordered chunk scheme as _pool_samples, the pooled file
+            # doesn't depend on the number of workers
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                pending = deque()
+                for index, row in input_manifest_df.iterrows():
+                    input_fp = os.path.join(
+                        demultiplexed_sequences_dirpath, str(row['filename']))
+                    chunk_fp = os.path.join(
+                        filtered_seqs_dirpath, sample_ids[index] + ".fasta")
+                    pending.append((index, chunk_fp, executor.submit(
+                        _filter_sample_to_chunk, input_fp, chunk_fp, sample_ids[index],
+                        filter_opts)))
+                    while len(pending) > 2 * n_jobs:
+                        _append_filtered_chunk(
+                            pending.popleft(), filtered_reads_fh, stats_df)
+                while pending:
+                    _append_filtered_chunk(
+                        pending.popleft(), filtered_reads_fh, stats_df)
 
-                
-                if use_temp_sample_ids:
-                    # keep track of samples
-                    pipeout_denoise_stats_df.loc[index, 'fixed_sample_id'] = sample_id
-                    sample_num = sample_num + 1
-    
-    # finally swap the index to fixed ids        
     if use_temp_sample_ids:
+        _swap_to_fixed_ids(stats_df, sample_ids)
 
-        pipeout_denoise_stats_df.reset_index(inplace=True)
-        pipeout_denoise_stats_df.rename(
-            columns={'sample-id': 'original_sample_id'}, inplace=True)
-        pipeout_denoise_stats_df.set_index('fixed_sample_id', inplace=True)
-        pipeout_denoise_stats_df.index.name = "sample-id"
+    input_stats_df = stats_df.drop(columns=['reads_passed_filter'])
+    filter_stats_df = stats_df[['reads_passed_filter']]
 
-    return pipeout_denoise_stats_df
+    return input_stats_df, filter_stats_df
 
 
 def _quality_control_cli(working_dir,
@@ -267,12 +421,26 @@ def _quality_control_cli(working_dir,
                          max_ns=None,
                          threads="auto",
                          use_vsearch: bool = False,
+                         use_native: bool = False,
+                         phred_offset=33,
                          verbose=True):
 
     pooled_seqs_fp = os.path.join(working_dir, "merged.fastq")
     filtered_reads_fp = os.path.join(working_dir, "filtered.fasta")
     log_fp = os.path.join(working_dir, "fastq_filter.log")
 
+    # the native engine doesn't do -fastq_truncqual
+    if use_native and min_qscore is None:
+        if verbose:
+            print("Now performing maxEE QC on input reads (native engine)...")
+        pass_counts = filter_fastq(pooled_seqs_fp, filtered_reads_fp,
+                                   stripleft=trim_left, trunclen=trunc_right,
+                                   minlen=min_len, maxee=max_ee, maxns=max_ns,
+                                   phred_offset=phred_offset,
+                                   threads=_resolve_threads(threads))
+        # per sample counts came out of the same pass, no rescan needed
+        return _pass_counts_to_df(pass_counts)
+
     # Building qc command
 
     if use_vsearch:
@@ -306,7 +474,7 @@ def _quality_control_cli(working_dir,
         print("Now performing maxEE QC on input reads...")
 
     # run command
-    fastq_filter_log = py_to_cli_interface(cmd, verbose)
+    fastq_filter_log = py_to_cli_interface(cmd, verbose, log_dir=working_dir)
 
     # get stats from log file
     # fastq_filter_stats = [info for info in fastq_filter_log if "Filtered reads" in info][0]
@@ -314,19 +482,41 @@ def _quality_control_cli(working_dir,
     # reads_passed_filter = int(fastq_filter_stats_lst[fastq_filter_stats_lst.index("Filtered") - 1])
 
     # do stats on a per sample bases
-    dna_seqs_gen = skbio.io.registry.read(
-        filtered_reads_fp, format="fasta", verify=True)
+    return _count_reads_per_sample(filtered_reads_fp)
 
-    seq_id_lst = [seq_id.metadata['id'] for seq_id in dna_seqs_gen]
 
-    stats_df = pd.DataFrame({'reads_passed_filter': seq_id_lst})
+_SCAN_BLOCK_SIZE = 8 * 1024 * 1024
 
-    stats_df['sample-id'] = stats_df["reads_passed_filter"].str.split(".", expand=True)[
-        0]
+# the sample prefix of a relabeled read id, i.e. "S1" in ">S1.123"
+_SAMPLE_PREFIX_RE = re.compile(rb'^>([^.\s]*)', re.MULTILINE)
 
-    stats_df = stats_df.groupby('sample-id').count()
 
-    return stats_df
+def _count_reads_per_sample(fasta_fp):
+    # only the headers matter here, scan the file in large blocks and tally
+    # the sample prefixes, memory use doesn't grow with the number of reads
+    counts = Counter()
+    tail = b''
+    with open(fasta_fp, 'rb') as fh:
+        while True:
+            block = fh.read(_SCAN_BLOCK_SIZE)
+            if not block:
+                break
+            buf = tail + block
+            # leave the last (possibly incomplete) line for the next block
+            cut = buf.rfind(b'\n') + 1
+            tail = buf[cut:]
+            counts.update(_SAMPLE_PREFIX_RE.findall(buf, 0, cut))
+    counts.update(_SAMPLE_PREFIX_RE.findall(tail))
+
+    return _pass_counts_to_df(counts)
+
+
+def _pass_counts_to_df(counts):
+    stats_df = pd.DataFrame(
+        {'reads_passed_filter': list(counts.values())},
+        index=pd.Index([sample_id.decode() for sample_id in counts], name='sample-id'))
+
+    return stats_df.sort_index()
 
 
 def _dereplicate_cli(working_dir,
@@ -334,12 +524,25 @@ def _dereplicate_cli(working_dir,
                      strand="plus",
                      threads="auto",
                      use_vsearch: bool = False,
+                     use_native: bool = False,
+                     shards=1,
                      verbose=True):
 
     filtered_reads_fp = os.path.join(working_dir, "filtered.fasta")
     unique_reads_fp = os.path.join(working_dir, "dereped.fasta")
     log_fp = os.path.join(working_dir, "fastx_uniques.log")
 
+    if use_native:
+        if verbose:
+            print("Now dereplicating filtered reads (native engine)...")
+        filtered_reads, unique_reads, singletons = dereplicate_fasta(
+            filtered_reads_fp, unique_reads_fp, strand=strand,
+            min_unique_size=min_unique_size, shards=shards)
+        if verbose:
+            print(str(filtered_reads) + " seqs, " + str(unique_reads) + " uniques, " +
+                  str(singletons) + " singletons\n")
+        return filtered_reads, unique_reads, singletons
+
     # Building dereplication command
 
     if use_vsearch:
@@ -347,15 +550,23 @@ def _dereplicate_cli(working_dir,
     else:
         cmd = ["usearch"]
 
+    # vsearch doesn't log the stats, they are counted from the size
+    # annotations of all the uniques and -minuniquesize is applied after
+    filter_after = use_vsearch and min_unique_size is not None
+    if filter_after:
+        derep_out_fp = os.path.join(working_dir, "dereped_all.fasta")
+    else:
+        derep_out_fp = unique_reads_fp
+
     cmd += [
         "-fastx_uniques", filtered_reads_fp,
-        "-fastaout", unique_reads_fp,
+        "-fastaout", derep_out_fp,
         "-sizeout",
         "-log", log_fp
     ]
 
     # Dereplication options
-    if min_unique_size is not None:
+    if min_unique_size is not None and not filter_after:
         cmd += ["-minuniquesize", str(min_unique_size)]
     if strand == "both":
         cmd += ["-strand", "both"]
@@ -363,13 +574,14 @@ def _dereplicate_cli(working_dir,
         cmd += ["-threads", str(threads)]
 
     # run command and get stats
-    derep_log = py_to_cli_interface(cmd, verbose)
+    derep_log = py_to_cli_interface(cmd, verbose, log_dir=working_dir)
 
     # get stats from log file
     if use_vsearch:
-        filtered_reads = "TBD"
-        unique_reads = "TBD"
-        singletons = "TBD"
+        filtered_reads, unique_reads, singletons = size_annotation_stats(derep_out_fp)
+        if filter_after:
+            filter_by_size(derep_out_fp, unique_reads_fp, min_unique_size)
+            os.remove(derep_out_fp)
 
     else:
         derep_stats = [
@@ -410,7 +622,7 @@ def _unoise_cli(working_dir,
         if unoise_alpha != 2.0:
             cmd += ["-alpha", str(unoise_alpha)]
 
-        silence = py_to_cli_interface(cmd, verbose)
+        silence = py_to_cli_interface(cmd, verbose, log_dir=working_dir)
 
     else:
         unoise_cmd = ["vsearch",
@@ -424,7 +636,7 @@ def _unoise_cli(working_dir,
         if unoise_alpha != 2.0:
             unoise_cmd += ["-alpha", str(unoise_alpha)]
 
-        py_to_cli_interface(unoise_cmd, verbose)
+        py_to_cli_interface(unoise_cmd, verbose, log_dir=working_dir)
 
         uchime_cmd = ["vsearch",
                       "--uchime3_denovo", vsearch_amplicon_fp,
@@ -432,7 +644,7 @@ def _unoise_cli(working_dir,
                       "--relabel_md5"
                       ]
 
-        silence = py_to_cli_interface(uchime_cmd, verbose)
+        silence = py_to_cli_interface(uchime_cmd, verbose, log_dir=working_dir)
 
 def _split_zotu_chimera(working_dir,
                         use_vsearch: bool = False,
@@ -446,46 +658,40 @@ def _split_zotu_chimera(working_dir,
     amplicons = 0
     zotus = 0
 
-    if not use_vsearch:
-        # used skbio and hashlib to hash the zotu ids
-        # convert lower case to upper here
-        dna_seqs_gen = skbio.io.registry.read(amplicons_fp, format="fasta", verify=True, lowercase=True)
-        with open(chimeras_fp, "wt") as chimeras_fh:
-            with open(zotus_fp, "wt") as zotus_fh:
-                # input seqs already sorted by decreasing abundance by usearch
-                for seq in dna_seqs_gen:
-                    if "amptype=chimera" in seq.metadata["id"]:
-                        seq.metadata["id"] = hashlib.md5(str(seq).upper().encode('utf-8')).hexdigest()
-                        seq.write(chimeras_fh, format="fasta", max_width=80)
-                    else:
-                        seq.metadata["id"] = hashlib.md5(str(seq).upper().encode('utf-8')).hexdigest()
-                        seq.write(zotus_fh, format="fasta", max_width=80)
-                        zotus += 1
-                    amplicons += 1
+    if use_vsearch:
+        # vsearch wrote the non chimeric amplicons to zotus.fasta with md5
+        # labels, that file is kept as it is and every amplicon missing from
+        # it is a chimera
+        zotu_labels = [label.split(b";")[0].decode()
+                       for label in read_fasta_labels(zotus_fp)]
+        zotu_ids = set(zotu_labels)
+        zotus = len(zotu_labels)
+        with open(chimeras_fp, 'wb') as chimeras_fh:
+            for label, seq in read_fasta(vsearch_amplicon_fp):
+                seq = seq.upper()
+                seq_id = hashlib.md5(seq).hexdigest()
+                if seq_id not in zotu_ids:
+                    write_fasta_record(chimeras_fh, seq_id, seq)
+                amplicons += 1
     else:
-        # use skbio to separate chimeras from amplicons
-        # Get zotu_ids
-        zotu_id_lst = [zotu.metadata["id"] for zotu in skbio.io.registry.read(
-            zotus_fp, format="fasta", verify=True)]
-        zotus = len(zotu_id_lst)
-        # Get amplicon_ids
-        amplicon_id_lst = [hashlib.md5(str(amplicon).upper().encode('utf-8')).hexdigest(
-        ) for amplicon in skbio.io.registry.read(vsearch_amplicon_fp, format="fasta", verify=True)]
-        amplicon_seqs_lst = [skbio.DNA(str(amplicon).upper(), metadata={'id': hashlib.md5(str(amplicon).upper().encode(
-            'utf-8')).hexdigest()}) for amplicon in skbio.io.registry.read(vsearch_amplicon_fp, format="fasta", verify=True)]
-        amplicons = len(amplicon_id_lst)
-
-        # Get chimeras
-        chimera_id_lst = [
-            amplicon_id for amplicon_id in amplicon_id_lst if amplicon_id not in zotu_id_lst]
-        chimera_seqs_lst = [
-            seq for seq in amplicon_seqs_lst if seq.metadata["id"] in chimera_id_lst]
-
-        # Write chimeras
-        with open(chimeras_fp, "wt") as f:
-            for seq in chimera_seqs_lst:
-                seq.write(f, format="fasta", max_width=80)
-                
+        # a single pass over the amplicons, hashed once each, writes both files
+        # input seqs already sorted by decreasing abundance by usearch
+        zotus_tmp_fp = zotus_fp + ".tmp"
+        with open(zotus_tmp_fp, 'wb') as zotus_fh, \
+                open(chimeras_fp, 'wb') as chimeras_fh:
+            for label, seq in read_fasta(amplicons_fp):
+                # convert lower case to upper here
+                seq = seq.upper()
+                seq_id = hashlib.md5(seq).hexdigest()
+                # usearch marks chimeras in the amplicon labels
+                if b"amptype=chimera" not in label:
+                    write_fasta_record(zotus_fh, seq_id, seq)
+                    zotus += 1
+                else:
+                    write_fasta_record(chimeras_fh, seq_id, seq)
+                amplicons += 1
+        os.replace(zotus_tmp_fp, zotus_fp)
+
     if verbose:
         print("Successfully split zotus and chimeras and converted to hashed ids")
         
@@ -515,9 +721,9 @@ def _cluster_zotus_cli(working_dir,
                "--usersort"
                ]
                
-    silence = py_to_cli_interface(cmd, verbose)
+    silence = py_to_cli_interface(cmd, verbose, log_dir=working_dir)
     
-    otus = len([seq for seq in skbio.io.registry.read(otus_fp, format="fasta", verify=True)])
+    otus = count_fasta_records(otus_fp)
     
     if verbose:
         print("Successfully clustered zotus into otus")
@@ -528,6 +734,7 @@ def _build_zotu_tab_cli(working_dir,
                         threads="auto",
                         chimera_map="vsearch",
                         use_vsearch: bool = False,
+                        map_filtered_reads: bool = False,
                         verbose=True):
 
     raw_reads_fp = os.path.join(working_dir, "merged.fastq")
@@ -550,6 +757,13 @@ def _build_zotu_tab_cli(working_dir,
                ]
 
     else:
+        # merged.fastq is never written when samples are filtered before
+        # pooling, the caller asks for the filtered reads to be mapped then
+        if map_filtered_reads:
+            raw_reads_fp = filtered_reads_fp
+        if not os.path.exists(raw_reads_fp):
+            raise FileNotFoundError(
+                "Could not find the reads to build the table from: " + raw_reads_fp)
         cmd = ["usearch",
                "-otutab", raw_reads_fp,
                "-zotus", zotus_fp
@@ -575,7 +789,7 @@ def _build_zotu_tab_cli(working_dir,
 
     # run command
     # we can do stats in another function
-    otutab_log = py_to_cli_interface(cmd, verbose)
+    otutab_log = py_to_cli_interface(cmd, verbose, log_dir=working_dir)
 
     # step2 search chimeras against unmatched fasta
     # build cmd
@@ -624,8 +838,8 @@ def _build_zotu_tab_cli(working_dir,
     # we can do stats in another function
     if os.path.exists(chimeras_fp):
         # 2nd layer of insurance
-        if len([ chimera for chimera in skbio.io.registry.read(chimeras_fp, format="fasta", verify=True)]) != 0:
-            chimera_log = py_to_cli_interface(chimera_cmd, verbose)
+        if not fasta_is_empty(chimeras_fp):
+            chimera_log = py_to_cli_interface(chimera_cmd, verbose, log_dir=working_dir)
             
             
 def _uparse_cli(working_dir,
@@ -648,36 +862,36 @@ def _uparse_cli(working_dir,
     if min_size != 2:
         cmd += ["-minsize", str(min_size)]
         
-    silence = py_to_cli_interface(cmd, verbose)
+    silence = py_to_cli_interface(cmd, verbose, log_dir=working_dir)
     
     # get otu count and reformat otu_ids to qiime2 format
     # convert to uppercase just in case
-    dna_seqs_gen = skbio.io.registry.read(otus_fp, format="fasta", verify=True, lowercase=True)
-    otu_seqs = [ seq for seq in dna_seqs_gen ]
-    otu_seq_count = len(otu_seqs)
-    os.remove(otus_fp)
-    with open(otus_fp, "wt") as f:
-        for seq in otu_seqs:
-            skbio.DNA(str(seq), metadata = {'id': hashlib.md5(str(seq).upper().encode('utf-8')).hexdigest()}).write(f, format="fasta", max_width=80)
+    otu_seq_count = 0
+    otus_tmp_fp = otus_fp + ".tmp"
+    with open(otus_tmp_fp, 'wb') as hashed_otus_fh:
+        for _, seq in read_fasta(otus_fp):
+            seq = seq.upper()
+            write_fasta_record(hashed_otus_fh, hashlib.md5(seq).hexdigest(), seq)
+            otu_seq_count += 1
+    os.replace(otus_tmp_fp, otus_fp)
 
     # indentify and retrive chimeras seqs
     # get chimera reads ids
-    
-    uparse_tab = pd.read_csv(uparse_tab_fp, sep="\t", header=None)
-    
-    try:
-        chimera_seqs_id_list = uparse_tab.loc[uparse_tab[1] == "noisy_chimera", 0].str.split(";", expand = True)[0].to_list()
-        chimera_seq_count = len(chimera_seqs_id_list)
-        dna_seqs_gen = skbio.io.registry.read(unique_reads_fp, format="fasta", verify=True)
-        chimera_seqs_lst = [ seq for seq in dna_seqs_gen if seq.metadata["id"].split(";")[0] in chimera_seqs_id_list ]
-        
-        # Write chimeras
-        with open(chimeras_fp, "wt") as f:
-            for seq in chimera_seqs_lst:
-                seq.write(f, format="fasta", max_width=80)
-                
-    except KeyError:
-        chimera_seq_count = 0
+    chimera_seqs_ids = set()
+    with open(uparse_tab_fp, 'rt') as uparse_tab_fh:
+        for line in uparse_tab_fh:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) > 1 and fields[1] == "noisy_chimera":
+                chimera_seqs_ids.add(fields[0].split(";")[0])
+    chimera_seq_count = len(chimera_seqs_ids)
+
+    if chimera_seq_count != 0:
+        # a single pass over the uniques, set lookups only
+        with open(chimeras_fp, 'wb') as chimeras_fh:
+            for label, seq in read_fasta(unique_reads_fp):
+                if label.split(b";")[0].decode() in chimera_seqs_ids:
+                    write_fasta_record(chimeras_fh, label.decode(), seq)
+    else:
         if verbose:
             print("No chimera seqs found, skipping checking chimera in input...")
 
@@ -691,6 +905,7 @@ def _build_otu_tab_cli(working_dir,
                        threads="auto",
                        chimera_map="vsearch",
                        use_vsearch: bool = False,
+                       map_filtered_reads: bool = False,
                        verbose=True):
 ################################################################################
     raw_reads_fp = os.path.join(working_dir, "merged.fastq")
@@ -713,6 +928,13 @@ def _build_otu_tab_cli(working_dir,
                ]
 
     else:
+        # merged.fastq is never written when samples are filtered before
+        # pooling, the caller asks for the filtered reads to be mapped then
+        if map_filtered_reads:
+            raw_reads_fp = filtered_reads_fp
+        if not os.path.exists(raw_reads_fp):
+            raise FileNotFoundError(
+                "Could not find the reads to build the table from: " + raw_reads_fp)
         cmd = ["usearch",
                "-otutab", raw_reads_fp,
                "-otus", otus_fp
@@ -738,7 +960,7 @@ def _build_otu_tab_cli(working_dir,
 
     # run command
     # we can do stats in another function
-    otutab_log = py_to_cli_interface(cmd, verbose)
+    otutab_log = py_to_cli_interface(cmd, verbose, log_dir=working_dir)
 
     # step2 search chimeras against unmatched fasta
     # build cmd
@@ -787,12 +1009,20 @@ def _build_otu_tab_cli(working_dir,
     # we can do stats in another function
     if os.path.exists(chimeras_fp):
         # 2nd layer of insurance
-        if len([ chimera for chimera in skbio.io.registry.read(chimeras_fp, format="fasta", verify=True)]) != 0:
-            chimera_log = py_to_cli_interface(chimera_cmd, verbose)
+        if not fasta_is_empty(chimeras_fp):
+            chimera_log = py_to_cli_interface(chimera_cmd, verbose, log_dir=working_dir)
 ################################################################################
 
 
+def _get_sample_id_map(input_stats_df):
+    # temp sample id -> original sample id, None if the ids were kept
+    if 'original_sample_id' in input_stats_df.columns:
+        return input_stats_df['original_sample_id'].to_dict()
+    return None
+
+
 def _prep_results_for_artifact_api(working_dir,
+                                   sample_id_map=None,
                                    verbose=True):
     # get filepaths
     zotus_fp = os.path.join(working_dir, "zotus.fasta")
@@ -813,31 +1043,43 @@ def _prep_results_for_artifact_api(working_dir,
     chimeratab_fp = os.path.join(working_dir, "chimera_tab.tsv")
 
     # process feature_tab
-    with open(tab_fp) as fh:
-        tab_df = biom.Table.from_tsv(fh, None, None, None).to_dataframe()
+    # the table stays sparse all the way, most features only show up in a
+    # few samples and the dense matrix can take several GB
+    # the tsv is read in blocks of rows, per sample totals come for free
+    counts, feature_ids, sample_ids, sample_sums = read_otutab(tab_fp)
 
     # get reads count mapped to zotus
-    reads_mapped_to_features_df = tab_df.sum().to_frame().astype('int')
+    reads_mapped_to_features_df = pd.DataFrame(
+        {"reads_mapped_to_features": sample_sums},
+        index=pd.Index(sample_ids, name="sample-id"))
     if dt_type == "zotu":
         reads_mapped_to_features_df.columns = ["reads_mapped_to_zotus"]
     elif dt_type == "otu":
         reads_mapped_to_features_df.columns = ["reads_mapped_to_otus"]
-    reads_mapped_to_features_df.index.name = "sample-id"
 
-    # sort featrue tab
-    tab_df = tab_df.reindex(tab_df.sum(axis=1).sort_values(ascending=False).index)
+    # sort featrue tab, most abundant first, ties keep the order in the tsv
+    order = np.argsort(-np.asarray(counts.sum(axis=1)).ravel(), kind="stable")
+    counts = counts[order]
+    feature_ids = [feature_ids[i] for i in order]
 
-    table = biom.Table(tab_df.values, tab_df.index, tab_df.columns)
+    # swap temp sample ids back before the table is built
+    if sample_id_map is not None:
+        table_sample_ids = [sample_id_map.get(sample_id, sample_id)
+                            for sample_id in sample_ids]
+    else:
+        table_sample_ids = sample_ids
+
+    table = biom.Table(counts, feature_ids, table_sample_ids)
 
     # process chimeratab
     if os.path.exists(chimeratab_fp):
-        with open(chimeratab_fp) as fh:
-            chimera_df = biom.Table.from_tsv(fh, None, None, None).to_dataframe()
+        # only the totals are needed here
+        chimera_tab = read_otutab(chimeratab_fp, keep_counts=False)
 
         # get reads count mapped to chimeras
-        reads_mapped_to_chimeras_df = chimera_df.sum().to_frame().astype('int')
-        reads_mapped_to_chimeras_df.columns = ["reads_mapped_to_chimeras"]
-        reads_mapped_to_chimeras_df.index.name = "sample-id"
+        reads_mapped_to_chimeras_df = pd.DataFrame(
+            {"reads_mapped_to_chimeras": chimera_tab.sample_sums},
+            index=pd.Index(chimera_tab.sample_ids, name="sample-id"))
         
     else:
         reads_mapped_to_chimeras_df = pd.DataFrame({"reads_mapped_to_chimeras": 0}, index=reads_mapped_to_features_df.index)
@@ -853,18 +1095,32 @@ def _prep_results_for_artifact_api(working_dir,
     # if the dataset is big enough, usearch will return mapped zotus and zotutab not 1: 1
     # furthermore, in usearch12, it seemed the mapped out output was broken, i.e. zotu in tab missing in mapped_zotus.fa
     # will raise a github issue to Edgar, meanwhile enforce fix here and in the table gen step
-    rep_seqs_lst = [ skbio.DNA(str(seq).upper(), metadata = {'id': seq.metadata['id']}) for seq in skbio.io.registry.read(features_fp, format="fasta", verify=True) ]
-    rep_seqs_id_lst = [ seq.metadata["id"] for seq in rep_seqs_lst ]
-    rep_sequences = pd.Series(rep_seqs_lst, index = rep_seqs_id_lst)
-    rep_seqs_dropped = rep_sequences[~rep_sequences.index.isin(tab_df.index)]
-    rep_sequences = rep_sequences[rep_sequences.index.isin(tab_df.index)]
-    rep_sequences = rep_sequences.reindex(tab_df.index)
-    if rep_sequences.isna().sum() > 0:
+    # seqs are kept as plain bytes and lined up with the table through an
+    # id -> position index, then written straight into the artifact's fasta,
+    # no skbio objects are built
+    rep_seqs_id_lst = []
+    rep_seqs_bytes_lst = []
+    for label, seq in read_fasta(features_fp):
+        rep_seqs_id_lst.append(label.split()[0].decode())
+        rep_seqs_bytes_lst.append(seq.upper())
+    rep_seqs_arr = np.array(rep_seqs_bytes_lst, dtype=object)
+    rep_seqs_pos = {seq_id: pos for pos, seq_id in enumerate(rep_seqs_id_lst)}
+    if any(feature_id not in rep_seqs_pos for feature_id in feature_ids):
         raise ValueError("DEBUG: Some features in feature table is not in rep-seqs...")
+    feature_ids_set = set(feature_ids)
+    rep_seqs_dropped = pd.Index(
+        [seq_id for seq_id in rep_seqs_id_lst if seq_id not in feature_ids_set])
+    rep_seqs_arr = rep_seqs_arr[
+        [rep_seqs_pos[feature_id] for feature_id in feature_ids]]
+    rep_sequences = DNAFASTAFormat()
+    with open(str(rep_sequences), 'wb') as fh:
+        # unwrapped, same as qiime2's own pd.Series -> fasta transformer
+        write_fasta_records(fh, zip(feature_ids, rep_seqs_arr), width=0)
 
     if verbose:
         if not rep_seqs_dropped.empty:
-            print('The following zOTUs were extracted by not mapped to zOTU table: ', rep_seqs_dropped.index, sep = '\nzOTU_ID: ')
+            print('The following zOTUs were extracted by not mapped to zOTU table: ',
+                  rep_seqs_dropped, sep='\nzOTU_ID: ')
             
         if dt_type == "zotu":
             print("Successfully sorted zotutab and zotus...")
@@ -882,32 +1138,64 @@ def denoise_no_primer_pooled(demultiplexed_sequences: SingleLanePerSampleSingleE
                                    min_size: int = 8,
                                    unoise_alpha: float = 2.0,
                                    use_vsearch: bool = False,
-                                   ) -> (biom.Table, pd.Series, qiime2.Metadata):
+                                   native_filter: bool = False,
+                                   filter_before_pooling: bool = False,
+                                   native_derep: bool = False,
+                                   derep_shards: int = 1,
+                                   ) -> (biom.Table, DNAFASTAFormat, qiime2.Metadata):
                                        
     verbose = True
 
+    profiler = StageProfiler('denoise_no_primer_pooled')
+
     demultiplexed_sequences_dirpath = str(demultiplexed_sequences)
     with tempfile.TemporaryDirectory() as usearch_wd:
-        input_stats_df = _pool_samples(
-            demultiplexed_sequences_dirpath, usearch_wd, use_vsearch=use_vsearch, verbose=verbose)
-        # need to sep for each sample as well
-        filter_stats_df = _quality_control_cli(usearch_wd, trim_left=trim_left, trunc_right=trunc_len,
-                                               min_len=min_len, max_ee=max_ee, use_vsearch=use_vsearch, threads=n_threads, verbose=verbose)
+        if filter_before_pooling:
+            with profiler.stage('filter_and_pool_samples'):
+                input_stats_df, filter_stats_df = _filter_and_pool_samples(
+                    demultiplexed_sequences_dirpath, usearch_wd, trim_left=trim_left,
+                    trunc_right=trunc_len, min_len=min_len, max_ee=max_ee,
+                    threads=n_threads, verbose=verbose)
+        else:
+            with profiler.stage('pool_samples'):
+                input_stats_df = _pool_samples(
+                    demultiplexed_sequences_dirpath, usearch_wd,
+                    use_vsearch=use_vsearch, threads=n_threads, verbose=verbose)
+            # need to sep for each sample as well
+            with profiler.stage('quality_control'):
+                phred_offset = _get_phred_offset(demultiplexed_sequences_dirpath)
+                filter_stats_df = _quality_control_cli(
+                    usearch_wd, trim_left=trim_left, trunc_right=trunc_len,
+                    min_len=min_len, max_ee=max_ee, use_vsearch=use_vsearch,
+                    use_native=native_filter,
+                    phred_offset=phred_offset, threads=n_threads, verbose=verbose)
     
-        filtered_reads_count, unique_reads_count, singletons_count, = _dereplicate_cli(
-            usearch_wd, use_vsearch=use_vsearch, threads=n_threads, verbose=verbose)
-        _unoise_cli(
-            usearch_wd, min_size=min_size, unoise_alpha=unoise_alpha, use_vsearch=use_vsearch, verbose=verbose)
-        amplicons_count, zotus_count, = _split_zotu_chimera(usearch_wd, use_vsearch=use_vsearch, verbose=verbose)
+        with profiler.stage('dereplicate'):
+            (filtered_reads_count, unique_reads_count,
+             singletons_count) = _dereplicate_cli(
+                usearch_wd, use_vsearch=use_vsearch, use_native=native_derep,
+                shards=derep_shards, threads=n_threads, verbose=verbose)
+        with profiler.stage('unoise'):
+            _unoise_cli(
+                usearch_wd, min_size=min_size, unoise_alpha=unoise_alpha,
+                use_vsearch=use_vsearch, verbose=verbose)
+        with profiler.stage('split_zotu_chimera'):
+            amplicons_count, zotus_count, = _split_zotu_chimera(
+                usearch_wd, use_vsearch=use_vsearch, verbose=verbose)
         
         denoise_stats_str = "Total Reads: " + str(filtered_reads_count) + " ;Unique Reads :" + str(unique_reads_count) + \
             " ;Singletons: " + str(singletons_count) + " ;Amplicons: " + \
             str(amplicons_count) + " ;zOTUs: " + str(zotus_count)
 
-        _build_zotu_tab_cli(usearch_wd, use_vsearch=use_vsearch,
-                            threads=n_threads, verbose=verbose)
-        table, representative_sequences, reads_mapped_to_zotus_df, reads_mapped_to_chimeras_df = _prep_results_for_artifact_api(
-            usearch_wd, verbose=verbose)
+        with profiler.stage('build_zotu_tab'):
+            _build_zotu_tab_cli(usearch_wd, use_vsearch=use_vsearch,
+                                map_filtered_reads=filter_before_pooling,
+                                threads=n_threads, verbose=verbose)
+        with profiler.stage('prep_results_for_artifact_api'):
+            (table, representative_sequences, reads_mapped_to_zotus_df,
+             reads_mapped_to_chimeras_df) = _prep_results_for_artifact_api(
+                usearch_wd, sample_id_map=_get_sample_id_map(input_stats_df),
+                verbose=verbose)
     
         # finally prep denoise stats df
         denoise_stats_df = input_stats_df.merge(
@@ -925,18 +1213,19 @@ def denoise_no_primer_pooled(demultiplexed_sequences: SingleLanePerSampleSingleE
         denoise_stats_df["denoise_stats_pooled_mode"] = denoise_stats_str
         
         # if sample ids were swapped during the run, we need to swap the sample ids back
+        # (the table got the original ids when it was built)
         if 'original_sample_id' in denoise_stats_df.columns:
             
-            id_map_dict = denoise_stats_df['original_sample_id'].to_dict()
             denoise_stats_df.index = denoise_stats_df['original_sample_id']
             denoise_stats_df.index.name = 'sample-id'
             denoise_stats_df.drop(columns=['original_sample_id'], inplace=True)
-            table.update_ids(id_map_dict, axis='sample', inplace=True)
             
         denoise_stats_df.fillna(0, inplace=True)
         
         denoising_stats = qiime2.Metadata(denoise_stats_df)
         
+    profiler.report(verbose)
+
     return table, representative_sequences, denoising_stats
 
 # do we need to expose additional uparse parameters here?
@@ -947,7 +1236,11 @@ def cluster_no_primer_pooled(demultiplexed_sequences: SingleLanePerSampleSingleE
                                    max_ee: float = 1.0,
                                    n_threads: str = "auto",
                                    min_size: int = 2,
-                                   ) -> (biom.Table, pd.Series, qiime2.Metadata):
+                                   native_filter: bool = False,
+                                   filter_before_pooling: bool = False,
+                                   native_derep: bool = False,
+                                   derep_shards: int = 1,
+                                   ) -> (biom.Table, DNAFASTAFormat, qiime2.Metadata):
                                        
     verbose = True
     
@@ -957,28 +1250,52 @@ def cluster_no_primer_pooled(demultiplexed_sequences: SingleLanePerSampleSingleE
         print("Further expalnation can be found here: https://drive5.com/usearch/manual/uparse_otu_radius.html")
         print("BTW uparse is also usearch exclusive, no vsearch support here.")
 
+    profiler = StageProfiler('cluster_no_primer_pooled')
+
     demultiplexed_sequences_dirpath = str(demultiplexed_sequences)
     with tempfile.TemporaryDirectory() as usearch_wd:
-        input_stats_df = _pool_samples(
-            demultiplexed_sequences_dirpath, usearch_wd, verbose=verbose)
-        # need to sep for each sample as well
-        filter_stats_df = _quality_control_cli(usearch_wd, trim_left=trim_left, trunc_right=trunc_len,
-                                               min_len=min_len, max_ee=max_ee, threads=n_threads, verbose=verbose)
+        if filter_before_pooling:
+            with profiler.stage('filter_and_pool_samples'):
+                input_stats_df, filter_stats_df = _filter_and_pool_samples(
+                    demultiplexed_sequences_dirpath, usearch_wd, trim_left=trim_left,
+                    trunc_right=trunc_len, min_len=min_len, max_ee=max_ee,
+                    threads=n_threads, verbose=verbose)
+        else:
+            with profiler.stage('pool_samples'):
+                input_stats_df = _pool_samples(
+                    demultiplexed_sequences_dirpath, usearch_wd, threads=n_threads,
+                    verbose=verbose)
+            # need to sep for each sample as well
+            with profiler.stage('quality_control'):
+                phred_offset = _get_phred_offset(demultiplexed_sequences_dirpath)
+                filter_stats_df = _quality_control_cli(
+                    usearch_wd, trim_left=trim_left, trunc_right=trunc_len,
+                    min_len=min_len, max_ee=max_ee, use_native=native_filter,
+                    phred_offset=phred_offset, threads=n_threads, verbose=verbose)
         # discarding singletons seemed not nessaary since the clust_otu command does it anyway...
         # need to check your self
-        filtered_reads_count, unique_reads_count, singletons_count, = _dereplicate_cli(
-            usearch_wd, threads=n_threads, verbose=verbose)
-        otu_seq_count, chimera_seq_count, = _uparse_cli(
-            usearch_wd, min_size=min_size, verbose=verbose)
+        with profiler.stage('dereplicate'):
+            (filtered_reads_count, unique_reads_count,
+             singletons_count) = _dereplicate_cli(
+                usearch_wd, use_native=native_derep, shards=derep_shards,
+                threads=n_threads, verbose=verbose)
+        with profiler.stage('uparse'):
+            otu_seq_count, chimera_seq_count, = _uparse_cli(
+                usearch_wd, min_size=min_size, verbose=verbose)
     
         denoise_stats_str = "Total Reads: " + str(filtered_reads_count) + " ;Unique Reads :" + str(unique_reads_count) + \
             " ;Singletons: " + str(singletons_count) + " ;OTUs: " + str(otu_seq_count) + \
             " :Chimeras: " + str(chimera_seq_count)
 
-        _build_otu_tab_cli(usearch_wd,
-                            threads=n_threads, verbose=verbose)
-        table, representative_sequences, reads_mapped_to_otus_df, reads_mapped_to_chimeras_df = _prep_results_for_artifact_api(
-            usearch_wd, verbose=verbose)
+        with profiler.stage('build_otu_tab'):
+            _build_otu_tab_cli(usearch_wd,
+                               map_filtered_reads=filter_before_pooling,
+                               threads=n_threads, verbose=verbose)
+        with profiler.stage('prep_results_for_artifact_api'):
+            (table, representative_sequences, reads_mapped_to_otus_df,
+             reads_mapped_to_chimeras_df) = _prep_results_for_artifact_api(
+                usearch_wd, sample_id_map=_get_sample_id_map(input_stats_df),
+                verbose=verbose)
     
         # finally prep denoise stats df
         denoise_stats_df = input_stats_df.merge(
@@ -996,18 +1313,19 @@ def cluster_no_primer_pooled(demultiplexed_sequences: SingleLanePerSampleSingleE
         denoise_stats_df["denoise_stats_pooled_mode"] = denoise_stats_str
         
         # if sample ids were swapped during the run, we need to swap the sample ids back
+        # (the table got the original ids when it was built)
         if 'original_sample_id' in denoise_stats_df.columns:
             
-            id_map_dict = denoise_stats_df['original_sample_id'].to_dict()
             denoise_stats_df.index = denoise_stats_df['original_sample_id']
             denoise_stats_df.index.name = 'sample-id'
             denoise_stats_df.drop(columns=['original_sample_id'], inplace=True)
-            table.update_ids(id_map_dict, axis='sample', inplace=True)
             
         denoise_stats_df.fillna(0, inplace=True)
         
         denoising_stats = qiime2.Metadata(denoise_stats_df)
         
+    profiler.report(verbose)
+
     return table, representative_sequences, denoising_stats
 
 def denoise_then_cluster_no_primer_pooled(demultiplexed_sequences: SingleLanePerSampleSingleEndFastqDirFmt,
@@ -1020,35 +1338,71 @@ def denoise_then_cluster_no_primer_pooled(demultiplexed_sequences: SingleLanePer
                                    min_size: int = 8,
                                    unoise_alpha: float = 2.0,
                                    use_vsearch: bool = False,
-                                   ) -> (biom.Table, pd.Series, qiime2.Metadata):
+                                   native_filter: bool = False,
+                                   filter_before_pooling: bool = False,
+                                   native_derep: bool = False,
+                                   derep_shards: int = 1,
+                                   ) -> (biom.Table, DNAFASTAFormat, qiime2.Metadata):
                                        
     verbose = True
 
+    profiler = StageProfiler('denoise_then_cluster_no_primer_pooled')
+
     demultiplexed_sequences_dirpath = str(demultiplexed_sequences)
     with tempfile.TemporaryDirectory() as usearch_wd:
-        input_stats_df = _pool_samples(
-            demultiplexed_sequences_dirpath, usearch_wd, use_vsearch=use_vsearch, verbose=verbose)
-        # need to sep for each sample as well
-        filter_stats_df = _quality_control_cli(usearch_wd, trim_left=trim_left, trunc_right=trunc_len,
-                                               min_len=min_len, max_ee=max_ee, use_vsearch=use_vsearch, threads=n_threads, verbose=verbose)
+        if filter_before_pooling:
+            with profiler.stage('filter_and_pool_samples'):
+                input_stats_df, filter_stats_df = _filter_and_pool_samples(
+                    demultiplexed_sequences_dirpath, usearch_wd, trim_left=trim_left,
+                    trunc_right=trunc_len, min_len=min_len, max_ee=max_ee,
+                    threads=n_threads, verbose=verbose)
+        else:
+            with profiler.stage('pool_samples'):
+                input_stats_df = _pool_samples(
+                    demultiplexed_sequences_dirpath, usearch_wd,
+                    use_vsearch=use_vsearch, threads=n_threads, verbose=verbose)
+            # need to sep for each sample as well
+            with profiler.stage('quality_control'):
+                phred_offset = _get_phred_offset(demultiplexed_sequences_dirpath)
+                filter_stats_df = _quality_control_cli(
+                    usearch_wd, trim_left=trim_left, trunc_right=trunc_len,
+                    min_len=min_len, max_ee=max_ee, use_vsearch=use_vsearch,
+                    use_native=native_filter,
+                    phred_offset=phred_offset, threads=n_threads, verbose=verbose)
     
-        filtered_reads_count, unique_reads_count, singletons_count, = _dereplicate_cli(
-            usearch_wd, use_vsearch=use_vsearch, threads=n_threads, verbose=verbose)
-        _unoise_cli(
-            usearch_wd, min_size=min_size, unoise_alpha=unoise_alpha, use_vsearch=use_vsearch, verbose=verbose)
+        with profiler.stage('dereplicate'):
+            (filtered_reads_count, unique_reads_count,
+             singletons_count) = _dereplicate_cli(
+                usearch_wd, use_vsearch=use_vsearch, use_native=native_derep,
+                shards=derep_shards, threads=n_threads, verbose=verbose)
+        with profiler.stage('unoise'):
+            _unoise_cli(
+                usearch_wd, min_size=min_size, unoise_alpha=unoise_alpha,
+                use_vsearch=use_vsearch, verbose=verbose)
     
-        amplicons_count, zotus_count, = _split_zotu_chimera(usearch_wd, use_vsearch=use_vsearch, verbose=verbose)
+        with profiler.stage('split_zotu_chimera'):
+            amplicons_count, zotus_count, = _split_zotu_chimera(
+                usearch_wd, use_vsearch=use_vsearch, verbose=verbose)
         
-        otus_count = _cluster_zotus_cli(usearch_wd, identity=perc_identity, use_vsearch=use_vsearch, verbose=verbose)
+        with profiler.stage('cluster_zotus'):
+            otus_count = _cluster_zotus_cli(
+                usearch_wd, identity=perc_identity, use_vsearch=use_vsearch,
+                verbose=verbose)
         
         denoise_stats_str = "Total Reads: " + str(filtered_reads_count) + " ;Unique Reads :" + str(unique_reads_count) + \
             " ;Singletons: " + str(singletons_count) + " ;Amplicons: " + \
             str(amplicons_count) + " ;ZOTUs: " + str(zotus_count) + " ;OTUs: " + str(otus_count)
 
-        _build_otu_tab_cli(usearch_wd, identity=perc_identity, use_vsearch=use_vsearch,
-                            threads=n_threads, verbose=verbose)
-        table, representative_sequences, reads_mapped_to_otus_df, reads_mapped_to_chimeras_df = _prep_results_for_artifact_api(
-            usearch_wd, verbose=verbose)
+        with profiler.stage('build_otu_tab'):
+            _build_otu_tab_cli(usearch_wd, identity=perc_identity,
+                               use_vsearch=use_vsearch,
+                               map_filtered_reads=filter_before_pooling,
+                               threads=n_threads, verbose=verbose)
+        with profiler.stage('prep_results_for_artifact_api'):
+            (table, representative_sequences, reads_mapped_to_otus_df,
+             reads_mapped_to_chimeras_df) = _prep_results_for_artifact_api(
+                usearch_wd, sample_id_map=_get_sample_id_map(input_stats_df),
+                verbose=verbose)
     
         # finally prep denoise stats df
         denoise_stats_df = input_stats_df.merge(
@@ -1066,17 +1420,18 @@ def denoise_then_cluster_no_primer_pooled(demultiplexed_sequences: SingleLanePer
         denoise_stats_df["denoise_stats_pooled_mode"] = denoise_stats_str
         
         # if sample ids were swapped during the run, we need to swap the sample ids back
+        # (the table got the original ids when it was built)
         if 'original_sample_id' in denoise_stats_df.columns:
             
-            id_map_dict = denoise_stats_df['original_sample_id'].to_dict()
             denoise_stats_df.index = denoise_stats_df['original_sample_id']
             denoise_stats_df.index.name = 'sample-id'
             denoise_stats_df.drop(columns=['original_sample_id'], inplace=True)
-            table.update_ids(id_map_dict, axis='sample', inplace=True)
             
         denoise_stats_df.fillna(0, inplace=True)
         
         denoising_stats = qiime2.Metadata(denoise_stats_df)
         
+    profiler.report(verbose)
+
     return table, representative_sequences, denoising_stats
 
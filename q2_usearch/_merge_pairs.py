@@ -14,7 +14,8 @@ from typing import List
 import gzip
 import tempfile
 import shutil
-import subprocess
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
 from q2_types.per_sample_sequences import (
@@ -22,15 +23,9 @@ from q2_types.per_sample_sequences import (
     SingleLanePerSamplePairedEndFastqDirFmt,
     FastqManifestFormat, YamlFormat)
 
-def run_command(cmd, verbose=True):
-    print("Running external command line application. This may print "
-          "messages to stdout and/or stderr.")
-    print("The command being run is below. This command cannot "
-          "be manually re-run as it will depend on temporary files that "
-          "no longer exist.")
-    print("\nCommand:", end=' ')
-    print(" ".join(cmd), end='\n\n')
-    subprocess.run(cmd, check=True)
+from ._fifo import GunzipFifo, GzipFifo
+from ._compress import gzip_writer, DEFAULT_COMPRESSION_LEVEL
+from ._runner import run_command
 
 
 _mp_defaults = {
@@ -46,8 +41,16 @@ _mp_defaults = {
     'threads': "auto", # vsearch default is 1
     'percent_identity': 90,
     # 'preset': None
+    'streaming': True, # pipe reads in and out of usearch instead of (un)zipping on disk
+    'compression_level': DEFAULT_COMPRESSION_LEVEL, # gzip.open defaults to 9
 }
 
+# usearch -fastq_mergepairs stops scaling well beyond a handful of threads,
+# so past this point it pays off to run more samples side by side instead
+_THREADS_PER_MERGE_JOB = 4
+
+_COPY_BUFSIZE = 1024 * 1024
+
 
 def merge_pairs(
     demultiplexed_seqs: SingleLanePerSamplePairedEndFastqDirFmt,
@@ -61,13 +64,16 @@ def merge_pairs(
     maxmergelen: int = _mp_defaults['maxmergelen'],
 #    preset: int = _mp_defaults['preset'],
     threads: str = _mp_defaults['threads'],
+    streaming: bool = _mp_defaults['streaming'],
+    compression_level: int = _mp_defaults['compression_level'],
 ) -> (
     SingleLanePerSampleSingleEndFastqDirFmt,
     SingleLanePerSamplePairedEndFastqDirFmt
 ):
     _, merged, unmerged = _merge_pairs_cli(
         demultiplexed_seqs, truncqual, minlen, allowmergestagger,
-        minovlen, maxdiffs, percent_identity, minmergelen, maxmergelen, threads
+        minovlen, maxdiffs, percent_identity, minmergelen, maxmergelen, threads,
+        streaming, compression_level
     )
 
     # if preset == 'double_reigon_short_overlap':
@@ -93,6 +99,8 @@ def _merge_pairs_cli(
     minmergelen: int = _mp_defaults['minmergelen'],
     maxmergelen: int = _mp_defaults['maxmergelen'],
     threads = _mp_defaults['threads'],
+    streaming: bool = _mp_defaults['streaming'],
+    compression_level: int = _mp_defaults['compression_level'],
 ) -> (
     List[str],
     SingleLanePerSampleSingleEndFastqDirFmt,
@@ -138,22 +146,28 @@ def _merge_pairs_cli(
         index='sample-id', columns='direction', values='filename'
     )
 
+    # named pipes are posix only
+    streaming = streaming and hasattr(os, 'mkfifo')
+    n_jobs, job_threads, usearch_threads, compression_threads = _plan_merge_jobs(
+        threads, len(id_to_fps), streaming)
+
     # create a temp folder to avoid corrupting Artifact filepath
     with tempfile.TemporaryDirectory() as temp_dir:
         os.mkdir(os.path.join(temp_dir, 'input'))
         os.mkdir(os.path.join(temp_dir, 'merged'))
         os.mkdir(os.path.join(temp_dir, 'unmerged'))
+        os.mkdir(os.path.join(temp_dir, 'logs'))
 
+        # output paths are resolved up front so that workers only ever see
+        # plain strings, and so that the manifests keep the input order
+        # no matter which sample finishes first
+        tasks = []
+        manifest_rows = []
         for i, (sample_id, (gzipped_fwd_fp, gzipped_rev_fp)) in enumerate(id_to_fps.iterrows()):
             # The barcode id and lane number are not relevant for either format.
             # We might ultimately want to use a dir format other than these which
             # doesn't care about this information.
             # The read number (direction) is only relevant for the unmerged reads.
-    
-            # prep input fps
-            fwd_fp, rev_fp = _unzip_seqs_for_usearch(sample_id, gzipped_fwd_fp, gzipped_rev_fp, os.path.join(temp_dir, "input"))
-                
-            # prep output fps
             gz_merged_path, fq_merged_path = _get_output_paths(
                 merged, sample_id, i, 1, os.path.join(temp_dir, "merged")
             )
@@ -163,75 +177,62 @@ def _merge_pairs_cli(
             gz_unmerged_rev_path, fq_unmerged_rev_path = _get_output_paths(
                 unmerged, sample_id, i, 2, os.path.join(temp_dir, "unmerged")
             )
-    
-            # build command
-            cmd = [
-                'usearch',
-                '-fastq_mergepairs', fwd_fp,
-                '-reverse', rev_fp,
-                '-fastqout', fq_merged_path,
-                '-fastqout_notmerged_fwd', fq_unmerged_fwd_path,
-                '-fastqout_notmerged_rev', fq_unmerged_rev_path,
-                '-fastq_minlen', str(minlen),
-                '-fastq_minovlen', str(minovlen),
-                '-fastq_maxdiffs', str(maxdiffs)
-            ]
-            
-            if percent_identity is not None:
-                cmd += ['-fastq_pctid', str(percent_identity)]
-            if truncqual is not None:
-                cmd += ['-fastq_trunctail', str(truncqual)]
-           # no such option in usearch
-           # if maxns is not None:
-           #     cmd += ['--fastq_maxns', str(maxns)]
-            if minmergelen is not None:
-                cmd += ['-fastq_minmergelen', str(minmergelen)]
-            if maxmergelen is not None:
-                cmd += ['-fastq_maxmergelen', str(maxmergelen)]
-            # if maxee is not None:
-            #     cmd += ['--fastq_maxee', str(maxee)]
-            if threads != "auto":
-                cmd += ['-threads', str(threads)]
-            if not allowmergestagger:
-                cmd.append('-fastq_nostagger')
-    
-            run_command(cmd)
-            
-            # remove input files
-            os.remove(fwd_fp)
-            os.remove(rev_fp)
-            
-            # zip all output files
-            with open(fq_merged_path, 'rb') as f_in:
-                with gzip.open(gz_merged_path, 'wb') as f_out:
-                    shutil.copyfileobj(f_in, f_out)
-                    
-            os.remove(fq_merged_path)
-            
-            with open(fq_unmerged_fwd_path, 'rb') as f_in:
-                with gzip.open(gz_unmerged_fwd_path, 'wb') as f_out:
-                    shutil.copyfileobj(f_in, f_out)
-            
-            os.remove(fq_unmerged_fwd_path)
-            
-            with open(fq_unmerged_rev_path, 'rb') as f_in:
-                with gzip.open(gz_unmerged_rev_path, 'wb') as f_out:
-                    shutil.copyfileobj(f_in, f_out)
-                    
-            os.remove(fq_unmerged_rev_path)
-            
-            # if it works why change it TT
-    
+            tasks.append({
+                'sample_id': sample_id,
+                'gzipped_fwd_fp': gzipped_fwd_fp,
+                'gzipped_rev_fp': gzipped_rev_fp,
+                'input_dir': os.path.join(temp_dir, "input"),
+                'log_dir': os.path.join(temp_dir, "logs"),
+                'outputs': [
+                    (fq_merged_path, str(gz_merged_path)),
+                    (fq_unmerged_fwd_path, str(gz_unmerged_fwd_path)),
+                    (fq_unmerged_rev_path, str(gz_unmerged_rev_path)),
+                ],
+            })
+            manifest_rows.append(
+                (sample_id, gz_merged_path.name, gz_unmerged_fwd_path.name,
+                 gz_unmerged_rev_path.name)
+            )
+
+        merge_opts = {
+            'truncqual': truncqual,
+            'minlen': minlen,
+            'allowmergestagger': allowmergestagger,
+            'minovlen': minovlen,
+            'maxdiffs': maxdiffs,
+            'percent_identity': percent_identity,
+            'minmergelen': minmergelen,
+            'maxmergelen': maxmergelen,
+            'threads': usearch_threads,
+            'compression_level': compression_level,
+            'compression_threads': compression_threads,
+            'streaming': streaming,
+        }
+
+        if n_jobs == 1:
+            cmds = [_merge_sample(task, merge_opts) for task in tasks]
+        else:
+            print("Merging %d samples with %d concurrent jobs, "
+                  "%d threads each..." % (len(tasks), n_jobs, job_threads))
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                # map() yields in submission order, a failed sample raises here
+                cmds = list(executor.map(
+                    _merge_sample, tasks, [merge_opts] * len(tasks)))
+
+        # if it works why change it TT
+        for sample_id, merged_fn, unmerged_fwd_fn, unmerged_rev_fn in manifest_rows:
             merged_manifest_fh.write(
-                '%s,%s,%s\n' % (sample_id, gz_merged_path.name, 'forward')
+                '%s,%s,%s\n' % (sample_id, merged_fn, 'forward')
             )
             unmerged_manifest_fh.write(
-                '%s,%s,%s\n' % (sample_id, gz_unmerged_fwd_path.name, 'forward')
+                '%s,%s,%s\n' % (sample_id, unmerged_fwd_fn, 'forward')
             )
             unmerged_manifest_fh.write(
-                '%s,%s,%s\n' % (sample_id, gz_unmerged_rev_path.name, 'reverse')
+                '%s,%s,%s\n' % (sample_id, unmerged_rev_fn, 'reverse')
             )
 
+        cmd = cmds[-1] if cmds else []
+
     merged_manifest_fh.close()
     unmerged_manifest_fh.close()
     merged.manifest.write_data(merged_manifest, FastqManifestFormat)
@@ -245,6 +246,113 @@ def _merge_pairs_cli(
     return cmd, merged, unmerged
 
 
+def _plan_merge_jobs(threads, n_samples, streaming):
+    # split the thread budget between concurrent samples
+    # when streaming, the three output compressors run next to usearch and
+    # their threads come out of the job's share first, otherwise the outputs
+    # are compressed one after another once usearch is done, each with the
+    # whole share. Either way a job is never holding more cores than it was
+    # given, except below 4 threads where each pipe still needs its one
+    # compressor thread
+    if threads == "auto":
+        budget = os.cpu_count() or 1
+    else:
+        budget = int(threads)
+    n_jobs = max(1, min(n_samples, budget // _THREADS_PER_MERGE_JOB))
+    job_threads = budget // n_jobs
+    if streaming:
+        # most of the reads end up merged, give that output the spare
+        # threads and compress the leftovers on one thread each
+        compression_threads = [max(1, job_threads // 4), 1, 1]
+        usearch_threads = max(1, job_threads - sum(compression_threads))
+        return n_jobs, job_threads, usearch_threads, compression_threads
+    compression_threads = [job_threads] * 3
+    if n_jobs == 1:
+        # one sample at a time, keep the old behaviour and let usearch decide
+        return 1, job_threads, threads, compression_threads
+    return n_jobs, job_threads, job_threads, compression_threads
+
+
+def _merge_sample(task, merge_opts):
+    # runs in a worker process, every argument must be picklable
+    sample_id = task['sample_id']
+
+    # prep input fps
+    if merge_opts['streaming']:
+        fwd_fp = os.path.join(task['input_dir'], sample_id + '_R1.fastq')
+        rev_fp = os.path.join(task['input_dir'], sample_id + '_R2.fastq')
+    else:
+        fwd_fp, rev_fp = _unzip_seqs_for_usearch(
+            sample_id, task['gzipped_fwd_fp'], task['gzipped_rev_fp'],
+            task['input_dir'])
+
+    ((fq_merged_path, _), (fq_unmerged_fwd_path, _),
+     (fq_unmerged_rev_path, _)) = task['outputs']
+
+    # build command
+    cmd = [
+        'usearch',
+        '-fastq_mergepairs', fwd_fp,
+        '-reverse', rev_fp,
+        '-fastqout', fq_merged_path,
+        '-fastqout_notmerged_fwd', fq_unmerged_fwd_path,
+        '-fastqout_notmerged_rev', fq_unmerged_rev_path,
+        '-fastq_minlen', str(merge_opts['minlen']),
+        '-fastq_minovlen', str(merge_opts['minovlen']),
+        '-fastq_maxdiffs', str(merge_opts['maxdiffs'])
+    ]
+
+    if merge_opts['percent_identity'] is not None:
+        cmd += ['-fastq_pctid', str(merge_opts['percent_identity'])]
+    if merge_opts['truncqual'] is not None:
+        cmd += ['-fastq_trunctail', str(merge_opts['truncqual'])]
+    # no such option in usearch
+    # if maxns is not None:
+    #     cmd += ['--fastq_maxns', str(maxns)]
+    if merge_opts['minmergelen'] is not None:
+        cmd += ['-fastq_minmergelen', str(merge_opts['minmergelen'])]
+    if merge_opts['maxmergelen'] is not None:
+        cmd += ['-fastq_maxmergelen', str(merge_opts['maxmergelen'])]
+    # if maxee is not None:
+    #     cmd += ['--fastq_maxee', str(maxee)]
+    if merge_opts['threads'] != "auto":
+        cmd += ['-threads', str(merge_opts['threads'])]
+    if not merge_opts['allowmergestagger']:
+        cmd.append('-fastq_nostagger')
+
+    if merge_opts['streaming']:
+        with ExitStack() as pipes:
+            # usearch reads fwd and rev in lockstep, so both pipes are fed at once
+            pipes.enter_context(GunzipFifo(task['gzipped_fwd_fp'], fwd_fp))
+            pipes.enter_context(GunzipFifo(task['gzipped_rev_fp'], rev_fp))
+            # and all three outputs are compressed while usearch writes them
+            for (fq_path, gz_path), n_threads in zip(
+                    task['outputs'], merge_opts['compression_threads']):
+                pipes.enter_context(GzipFifo(
+                    fq_path, gz_path, merge_opts['compression_level'], n_threads))
+            run_command(cmd, task['log_dir'],
+                        step='usearch_fastq_mergepairs_' + sample_id)
+    else:
+        run_command(cmd, task['log_dir'],
+                    step='usearch_fastq_mergepairs_' + sample_id)
+
+        # remove input files
+        os.remove(fwd_fp)
+        os.remove(rev_fp)
+
+        # zip all output files
+        # one after another here, each file may use all of the job's threads
+        for (fq_path, gz_path), n_threads in zip(
+                task['outputs'], merge_opts['compression_threads']):
+            with open(fq_path, 'rb') as f_in:
+                with gzip_writer(gz_path, merge_opts['compression_level'],
+                                 n_threads) as f_out:
+                    shutil.copyfileobj(f_in, f_out, _COPY_BUFSIZE)
+            os.remove(fq_path)
+
+    return cmd
+
+
 def _get_output_paths(format_, sample_id, barcode_id, direction, temp_folder):
     path = format_.sequences.path_maker(
         sample_id=sample_id,
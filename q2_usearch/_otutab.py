@@ -0,0 +1,84 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2024, magicprotoss;biodps.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+from collections import namedtuple
+from itertools import islice
+
+import numpy as np
+import scipy.sparse
+
+# Reader for u/vsearch -otutabout files: "#OTU ID" and the sample ids on the
+# first line, then one line of counts per feature. Deep runs make these
+# files huge and mostly zeros, so they are parsed a block of rows at a time
+# into (row, col, count) triplets of the non zero counts only, with the per
+# sample totals summed up on the way. A block holds at most a fixed number
+# of counts, wide tables just get fewer rows per block, so memory is bounded
+# by the block size plus the non zero counts whatever the number of samples.
+
+OtuTable = namedtuple(
+    'OtuTable', ['counts', 'feature_ids', 'sample_ids', 'sample_sums'])
+
+# counts per block, 32 MB of float64
+_OTUTAB_BLOCK_CELLS = 4 * 1024 * 1024
+
+
+def read_otutab(tab_fp, keep_counts=True, block_cells=_OTUTAB_BLOCK_CELLS):
+    """Read an otutab into a features x samples csr matrix.
+
+    With ``keep_counts=False`` only the per sample totals are collected and
+    ``counts`` is None, for tables that only feed the stats.
+    """
+    feature_ids = []
+    rows, cols, vals = [], [], []
+    with open(tab_fp, 'rt') as fh:
+        sample_ids = fh.readline().rstrip('\n').split('\t')[1:]
+        n_samples = len(sample_ids)
+        sample_sums = np.zeros(n_samples)
+        block = np.empty((max(1, block_cells // max(1, n_samples)), n_samples))
+        while True:
+            block_ids = _parse_block(fh, block)
+            if not block_ids:
+                break
+            filled = block[:len(block_ids)]
+            sample_sums += filled.sum(axis=0)
+            if keep_counts:
+                block_rows_idx, block_cols = np.nonzero(filled)
+                rows.append(block_rows_idx + len(feature_ids))
+                cols.append(block_cols)
+                vals.append(filled[block_rows_idx, block_cols])
+                feature_ids += block_ids
+
+    counts = None
+    if keep_counts:
+        counts = scipy.sparse.coo_matrix(
+            (_concat(vals, np.float64),
+             (_concat(rows, np.int64), _concat(cols, np.int64))),
+            shape=(len(feature_ids), n_samples)).tocsr()
+    return OtuTable(counts, feature_ids, sample_ids, sample_sums.astype('int'))
+
+
+def _parse_block(fh, block):
+    # fills ``block`` row by row, numbers are parsed straight from the line
+    # so no per count string is ever built. Returns the ids of the rows read
+    n_samples = block.shape[1]
+    ids = []
+    for line in islice(fh, block.shape[0]):
+        feature_id, _, row = line.rstrip('\n').partition('\t')
+        values = np.fromstring(row, sep='\t') if n_samples else block[0, :0]
+        if values.size != n_samples:
+            raise ValueError(
+                "Malformed otutab, expected %d counts per feature" % n_samples)
+        block[len(ids)] = values
+        ids.append(feature_id)
+    return ids
+
+
+def _concat(arrays, dtype):
+    if not arrays:
+        return np.zeros(0, dtype=dtype)
+    return np.concatenate(arrays).astype(dtype, copy=False)
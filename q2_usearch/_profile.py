@@ -0,0 +1,124 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2024, magicprotoss;biodps.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import sys
+import json
+import time
+import resource
+from contextlib import contextmanager
+
+# Per stage wall time, cpu time, peak rss and i/o of the pooled pipelines.
+# Set Q2_USEARCH_PROFILE to a file path to get the numbers as json,
+# e.g. Q2_USEARCH_PROFILE=profile.json qiime usearch denoise-no-primer-pooled ...
+
+PROFILE_ENV_VAR = 'Q2_USEARCH_PROFILE'
+
+# ru_maxrss is in kilobytes on linux and in bytes on macos
+_MAXRSS_TO_MB = 1 / 1024 ** 2 if sys.platform == 'darwin' else 1 / 1024
+
+
+def _io_bytes():
+    # bytes read and written through read()/write() calls, and the part of
+    # them that actually hit the disk (page cache hits don't), None when
+    # unknown. /proc/self/io includes the children we already waited for,
+    # which is where usearch does all of its reading and writing
+    try:
+        with open('/proc/self/io') as fh:
+            counters = dict(line.split(': ') for line in fh.read().splitlines())
+        return (int(counters['rchar']), int(counters['wchar']),
+                int(counters['read_bytes']), int(counters['write_bytes']))
+    except (OSError, KeyError, ValueError):
+        # no procfs, only the block counts (512 byte units) are known
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return (None, None,
+                (own.ru_inblock + children.ru_inblock) * 512,
+                (own.ru_oublock + children.ru_oublock) * 512)
+
+
+def _delta(before, after):
+    if before is None or after is None:
+        return None
+    return after - before
+
+
+def _snapshot():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    read_bytes, write_bytes, disk_read_bytes, disk_write_bytes = _io_bytes()
+    return {
+        'wall': time.perf_counter(),
+        'cpu_self': own.ru_utime + own.ru_stime,
+        'cpu_children': children.ru_utime + children.ru_stime,
+        'maxrss_self': own.ru_maxrss,
+        'maxrss_children': children.ru_maxrss,
+        'read_bytes': read_bytes,
+        'write_bytes': write_bytes,
+        'disk_read_bytes': disk_read_bytes,
+        'disk_write_bytes': disk_write_bytes,
+    }
+
+
+def _mb(n_bytes):
+    return 'n/a' if n_bytes is None else '%.1f' % (n_bytes / 1e6)
+
+
+class StageProfiler:
+    """Collects resource usage for each stage of a pipeline run."""
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name):
+        before = _snapshot()
+        try:
+            yield
+        finally:
+            after = _snapshot()
+            self.stages.append({
+                'stage': name,
+                'wall_time_s': round(after['wall'] - before['wall'], 3),
+                'cpu_time_s': round(after['cpu_self'] - before['cpu_self'], 3),
+                'child_cpu_time_s': round(
+                    after['cpu_children'] - before['cpu_children'], 3),
+                # peaks are process wide, they only ever go up, so a stage
+                # shows the highest peak seen up to the end of that stage
+                'peak_rss_mb': round(after['maxrss_self'] * _MAXRSS_TO_MB, 1),
+                'peak_child_rss_mb': round(
+                    after['maxrss_children'] * _MAXRSS_TO_MB, 1),
+                'bytes_read': _delta(before['read_bytes'], after['read_bytes']),
+                'bytes_written': _delta(before['write_bytes'], after['write_bytes']),
+                'disk_bytes_read': _delta(
+                    before['disk_read_bytes'], after['disk_read_bytes']),
+                'disk_bytes_written': _delta(
+                    before['disk_write_bytes'], after['disk_write_bytes']),
+            })
+
+    def report(self, verbose=True):
+        if verbose:
+            print("\nTime and resources spent per stage:")
+            print("%-32s %10s %10s %12s %10s %12s %12s %12s %12s" % (
+                'stage', 'wall_s', 'cpu_s', 'child_cpu_s', 'peak_mb',
+                'read_mb', 'written_mb', 'disk_read_mb', 'disk_wrtn_mb'))
+            for s in self.stages:
+                print("%-32s %10.1f %10.1f %12.1f %10.1f %12s %12s %12s %12s" % (
+                    s['stage'], s['wall_time_s'], s['cpu_time_s'],
+                    s['child_cpu_time_s'],
+                    max(s['peak_rss_mb'], s['peak_child_rss_mb']),
+                    _mb(s['bytes_read']), _mb(s['bytes_written']),
+                    _mb(s['disk_bytes_read']), _mb(s['disk_bytes_written'])))
+        profile_fp = os.environ.get(PROFILE_ENV_VAR)
+        if profile_fp:
+            with open(profile_fp, 'wt') as fh:
+                json.dump({'pipeline': self.pipeline, 'stages': self.stages},
+                          fh, indent=2)
+            if verbose:
+                print("Profile written to " + profile_fp)
@@ -0,0 +1,162 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2024, magicprotoss;biodps.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import time
+import shutil
+import tempfile
+
+# On-disk cache for reference databases that take long to prepare (i.e. the
+# sintax fasta + udb index of SILVA), shared by every run on the machine.
+# Entries live in <cache dir>/<key>/, the key is a hash of everything that
+# went into building the entry, so an entry never has to be invalidated.
+# Least recently used entries are evicted once the cache grows above its
+# size cap.
+#
+# Q2_USEARCH_CACHE_DIR      cache location, "off" disables the cache
+#                           (default: $XDG_CACHE_HOME/q2-usearch or
+#                           ~/.cache/q2-usearch)
+# Q2_USEARCH_CACHE_MAX_GB   size cap in GB (default: 10)
+
+CACHE_DIR_ENV_VAR = 'Q2_USEARCH_CACHE_DIR'
+CACHE_MAX_GB_ENV_VAR = 'Q2_USEARCH_CACHE_MAX_GB'
+
+_DEFAULT_CACHE_MAX_GB = 10.0
+
+# touched every time an entry is used, its mtime orders the eviction
+_LAST_USED_FN = '.last_used'
+
+_HASH_BLOCK_RECORDS = 10000
+_HASH_BLOCK_SIZE = 8 * 1024 * 1024
+
+
+def cache_dir(namespace):
+    """Directory of the ``namespace`` cache, None if caching is disabled."""
+    root = os.environ.get(CACHE_DIR_ENV_VAR)
+    if root is not None and root.strip().lower() in ('', 'off', 'false', '0', 'no'):
+        return None
+    if root is None:
+        root = os.path.join(
+            os.environ.get('XDG_CACHE_HOME',
+                           os.path.join(os.path.expanduser('~'), '.cache')),
+            'q2-usearch')
+    path = os.path.join(root, namespace)
+    try:
+        os.makedirs(path, exist_ok=True)
+    except OSError:
+        # read-only home and the like, run without the cache
+        return None
+    return path
+
+
+def hash_records(hasher, records):
+    """Feed ``(id, value)`` pairs to ``hasher`` in blocks."""
+    block = []
+    for record_id, value in records:
+        block.append('%s\t%s\n' % (record_id, value))
+        if len(block) == _HASH_BLOCK_RECORDS:
+            hasher.update(''.join(block).encode('utf-8'))
+            block = []
+    hasher.update(''.join(block).encode('utf-8'))
+    # separate consecutive inputs
+    hasher.update(b'\0')
+
+
+def hash_file(hasher, fp):
+    """Feed the content of ``fp`` to ``hasher`` in blocks."""
+    with open(fp, 'rb') as fh:
+        while True:
+            block = fh.read(_HASH_BLOCK_SIZE)
+            if not block:
+                break
+            hasher.update(block)
+    hasher.update(b'\0')
+
+
+def get_or_build(root, key, build, verbose=True):
+    """Return the entry directory for ``key``, building it on a miss.
+
+    ``build`` is called with an empty directory to fill. It is built next
+    to the cache and renamed into place once complete, so a crashed or
+    concurrent build never leaves a half written entry behind.
+    """
+    entry_dir = os.path.join(root, key)
+    if os.path.isdir(entry_dir):
+        if verbose:
+            print("Using cached reference database " + entry_dir)
+        _touch(entry_dir)
+        return entry_dir
+
+    if verbose:
+        print("Reference database not cached yet, building it in " + root)
+    build_dir = tempfile.mkdtemp(prefix='.build-', dir=root)
+    try:
+        build(build_dir)
+        _touch(build_dir)
+        try:
+            os.rename(build_dir, entry_dir)
+        except OSError:
+            # another run finished the same entry first, use theirs
+            if not os.path.isdir(entry_dir):
+                raise
+    finally:
+        if os.path.isdir(build_dir):
+            shutil.rmtree(build_dir, ignore_errors=True)
+
+    _evict(root, keep=key, verbose=verbose)
+    return entry_dir
+
+
+def _touch(entry_dir):
+    with open(os.path.join(entry_dir, _LAST_USED_FN), 'wt') as fh:
+        fh.write(str(time.time()))
+
+
+def _dir_size(path):
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for fn in filenames:
+            try:
+                size += os.path.getsize(os.path.join(dirpath, fn))
+            except OSError:
+                pass
+    return size
+
+
+def _last_used(entry_dir):
+    try:
+        return os.path.getmtime(os.path.join(entry_dir, _LAST_USED_FN))
+    except OSError:
+        return 0.0
+
+
+def _max_cache_bytes():
+    try:
+        max_gb = float(os.environ.get(CACHE_MAX_GB_ENV_VAR, _DEFAULT_CACHE_MAX_GB))
+    except ValueError:
+        max_gb = _DEFAULT_CACHE_MAX_GB
+    return int(max_gb * 1024 ** 3)
+
+
+def _evict(root, keep, verbose=True):
+    # drop least recently used entries until the cache fits its cap again,
+    # the entry just built is kept even if it is over the cap on its own
+    entries = [name for name in os.listdir(root)
+               if not name.startswith('.') and os.path.isdir(os.path.join(root, name))]
+    sizes = {name: _dir_size(os.path.join(root, name)) for name in entries}
+    total = sum(sizes.values())
+    max_bytes = _max_cache_bytes()
+    for name in sorted(entries, key=lambda name: _last_used(os.path.join(root, name))):
+        if total <= max_bytes:
+            break
+        if name == keep:
+            continue
+        if verbose:
+            print("Evicting cached reference database " + name)
+        shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+        total -= sizes[name]
@@ -0,0 +1,98 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2024, magicprotoss;biodps.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import re
+import time
+import subprocess
+from collections import namedtuple
+
+# Every external command of the plug-in goes through run_command(), which
+# starts it right away, captures stdout/stderr to per step log files in the
+# working dir and reports how long it took and how it exited.
+
+CommandResult = namedtuple(
+    'CommandResult', ['cmd', 'returncode', 'elapsed', 'stdout_fp', 'stderr_fp'])
+
+# lines of stderr shown when a command fails
+_ERROR_TAIL_LINES = 20
+
+
+def run_command(cmd, log_dir, step=None, verbose=True):
+    """Run ``cmd`` with its output captured to ``<log_dir>/<nn>_<step>.*.log``.
+
+    Raises ``subprocess.CalledProcessError`` on a non-zero exit status, with
+    the tail of stderr attached and printed.
+    """
+    if step is None:
+        step = _step_name(cmd)
+    stdout_fp, stderr_fp = _step_log_fps(log_dir, step)
+
+    if verbose:
+        print("Running external command line application. This may print "
+              "messages to stdout and/or stderr.")
+        print("The command(s) being run are below. These commands cannot "
+              "be manually re-run as they will depend on temporary files that "
+              "no longer exist.")
+        print("\nCommand:", end=' ')
+        print(" ".join(cmd), end='\n\n')
+
+    start = time.perf_counter()
+    with open(stdout_fp, 'wb') as stdout_fh, open(stderr_fp, 'wb') as stderr_fh:
+        returncode = subprocess.run(cmd, stdout=stdout_fh, stderr=stderr_fh).returncode
+    elapsed = time.perf_counter() - start
+
+    if verbose:
+        _echo(stdout_fp)
+        _echo(stderr_fp)
+        print("Finished %s in %.1fs with exit status %d\n" % (
+            step, elapsed, returncode))
+
+    if returncode != 0:
+        stderr_tail = _tail(stderr_fp)
+        print("Command failed with exit status %d, last lines of stderr:\n%s"
+              % (returncode, stderr_tail))
+        raise subprocess.CalledProcessError(returncode, cmd, stderr=stderr_tail)
+
+    return CommandResult(cmd, returncode, elapsed, stdout_fp, stderr_fp)
+
+
+def _step_name(cmd):
+    # i.e. ['usearch', '-fastq_filter', ...] -> usearch_fastq_filter
+    name = os.path.basename(cmd[0])
+    if len(cmd) > 1 and cmd[1].startswith('-'):
+        name += '_' + cmd[1].lstrip('-')
+    return re.sub(r'[^A-Za-z0-9_.]', '_', name)
+
+
+def _step_log_fps(log_dir, step):
+    # number the steps so a command run once per sample keeps every log
+    n = 1
+    while True:
+        prefix = os.path.join(log_dir, '%02d_%s' % (n, step))
+        if not os.path.exists(prefix + '.stdout.log'):
+            # claim the name right away, parallel workers share log_dir
+            try:
+                open(prefix + '.stdout.log', 'x').close()
+                return prefix + '.stdout.log', prefix + '.stderr.log'
+            except FileExistsError:
+                pass
+        n += 1
+
+
+def _echo(fp):
+    with open(fp, 'rt', errors='replace') as fh:
+        text = fh.read()
+    if text:
+        print(text, end='' if text.endswith('\n') else '\n')
+
+
+def _tail(fp, n_lines=_ERROR_TAIL_LINES):
+    with open(fp, 'rt', errors='replace') as fh:
+        lines = fh.read().replace('\r', '\n').splitlines()
+    return '\n'.join(line for line in lines[-n_lines:] if line.strip())
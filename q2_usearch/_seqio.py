@@ -0,0 +1,124 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2024, magicprotoss;biodps.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import re
+import mmap
+
+# Minimal fasta i/o for the working files of the plug-in. u/vsearch write
+# these files themselves, so there is nothing to validate, only ids and
+# sequences to pull out. Everything is bytes and read in large blocks,
+# skbio is only needed where the results are handed back to qiime2.
+
+_SEQIO_BLOCK_SIZE = 8 * 1024 * 1024
+
+_HEADER_RE = re.compile(rb'^>([^\r\n]*)', re.MULTILINE)
+
+
+def read_fasta(fp):
+    """Yield ``(label, sequence)`` bytes pairs, wrapped sequences joined."""
+    with open(fp, 'rb') as fh:
+        yield from iter_fasta_records(fh)
+
+
+def read_fasta_labels(fp):
+    """Yield the labels of a fasta file, sequences are never assembled."""
+    tail = b''
+    with open(fp, 'rb') as fh:
+        while True:
+            block = fh.read(_SEQIO_BLOCK_SIZE)
+            if not block:
+                break
+            buf = tail + block
+            # leave the last (possibly incomplete) line for the next block
+            cut = buf.rfind(b'\n') + 1
+            tail = buf[cut:]
+            yield from _HEADER_RE.findall(buf, 0, cut)
+    yield from _HEADER_RE.findall(tail)
+
+
+def read_fasta_seqs(fp):
+    """Yield the sequences of a fasta file, wrapped sequences joined."""
+    for _, seq in read_fasta(fp):
+        yield seq
+
+
+def iter_fasta_records(fh):
+    # same as read_fasta() on an open binary file handle
+    tail = b''
+    while True:
+        block = fh.read(_SEQIO_BLOCK_SIZE)
+        if not block:
+            break
+        records = (tail + block).split(b'\n>')
+        # the last record may continue in the next block
+        tail = records.pop()
+        for record in records:
+            yield _parse_record(record)
+    if tail.strip():
+        yield _parse_record(tail)
+
+
+def _parse_record(record):
+    lines = record.split(b'\n')
+    return lines[0].lstrip(b'>').rstrip(b'\r'), b''.join(lines[1:]).replace(b'\r', b'')
+
+
+def write_fasta_record(fh, label, seq, width=80):
+    """Write one record to a binary file handle, wrapped at ``width``.
+
+    Same layout as skbio's fasta writer with ``max_width=width``, a width of
+    0 writes the sequence on a single line.
+    """
+    fh.write(_format_record(label, seq, width))
+
+
+def write_fasta_records(fh, records, width=80):
+    """Write ``(label, sequence)`` pairs with a single write call.
+
+    Meant for blocks of records, see ``write_fasta_record`` for the layout.
+    """
+    fh.write(b''.join([_format_record(label, seq, width) for label, seq in records]))
+
+
+def _format_record(label, seq, width):
+    if isinstance(label, str):
+        label = label.encode()
+    if isinstance(seq, str):
+        seq = seq.encode()
+    if width and len(seq) > width:
+        seq = b'\n'.join([seq[i:i + width] for i in range(0, len(seq), width)])
+    return b'>' + label + b'\n' + seq + b'\n'
+
+
+def count_fasta_records(fp, stop_after=None):
+    """Count the records of a fasta file without parsing it.
+
+    The file is memory mapped and searched for record starts block by
+    block. With ``stop_after`` the count stops as soon as that many records
+    were seen, i.e. ``stop_after=1`` only checks for emptiness.
+    """
+    size = os.path.getsize(fp)
+    if size == 0:
+        # can't mmap an empty file
+        return 0
+    with open(fp, 'rb') as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        count = 1 if mm[:1] == b'>' else 0
+        for start in range(0, size, _SEQIO_BLOCK_SIZE):
+            if stop_after is not None and count >= stop_after:
+                return stop_after
+            # step back one byte so a "\n>" across blocks is seen once
+            count += mm[max(start - 1, 0):start + _SEQIO_BLOCK_SIZE].count(b'\n>')
+    if stop_after is not None:
+        return min(count, stop_after)
+    return count
+
+
+def fasta_is_empty(fp):
+    """True if the fasta file holds no records, only looks at its start."""
+    return count_fasta_records(fp, stop_after=1) == 0
@@ -1,11 +1,16 @@
 import pandas as pd
 import numpy as np
-import re
 import os
-import skbio
-import subprocess
 import tempfile
 import hashlib
+import shutil
+from itertools import islice
+from q2_types.feature_data import DNAFASTAFormat
+
+from ._runner import run_command
+from ._refcache import cache_dir, get_or_build, hash_file, hash_records
+from ._format import USEARCHSintaxDBDirFmt
+from ._seqio import iter_fasta_records, write_fasta_record, write_fasta_records
 
 # need to imporve
 # reverse strand
@@ -13,24 +18,15 @@ import hashlib
 # check output empty befor and after conf slit
 
 
-def run_commands(cmds, verbose=True):
-    if verbose:
-        print("Running external command line application(s). This may print "
-              "messages to stdout and/or stderr.")
-        print("The command(s) being run are below. These commands cannot "
-              "be manually re-run as they will depend on temporary files that "
-              "no longer exist.")
+def run_commands(cmds, working_dir, verbose=True):
     for cmd in cmds:
-        if verbose:
-            print("\nCommand:", end=' ')
-            print(" ".join(cmd), end='\n\n')
-        subprocess.run(cmd, check=True)
+        run_command(cmd, working_dir, verbose=verbose)
 
 
 def _get_input_seqs_ids_and_dump_to_fasta(working_dir, query_se):
-    with open(os.path.join(working_dir, 'query.fasta'), 'wt') as fh:
+    with open(os.path.join(working_dir, 'query.fasta'), 'wb') as fh:
         for index, item in query_se.items():
-            item.write(fh, format="fasta", max_width=80)
+            write_fasta_record(fh, str(index), str(item))
     empty_df_w_input_seqs_labs = pd.DataFrame(index=query_se.index)
     return empty_df_w_input_seqs_labs
 
@@ -49,81 +45,109 @@ def _split_tax_into_ranks_and_get_max_levels(tax_df_in, sep):
     return max_levels, tax_rank_split_se
 
 
-def _replace_q2_split_w_usearch_split_and_remove_leading_trailing_blanks(rank_in):
-    rank_out = re.sub(r"(?<=\b[dpcofgs])\w*__", ':', str(rank_in).strip())
-    return rank_out
+def _replace_q2_split_w_usearch_split_and_remove_leading_trailing_blanks(ranks_in):
+    # ranks_in holds the distinct labels of a level, NaN stays NaN
+    ranks_out = ranks_in.str.strip().str.replace(
+        r"(?<=\b[dpcofgs])\w*__", ':', regex=True)
+    return ranks_out
 
 
-def _replace_non_7bit_ascii_chars(rank_in):
-    rank_out = rank_in
+def _replace_non_7bit_ascii_chars(ranks_in):
+    ranks_out = ranks_in.copy()
 
     # let's KISS here...
-    if re.search(r'[^A-Za-z0-9_.]', rank_in):
-        if re.match(r'^[kdpcofgs]', str(rank_in).strip()):
-            rank_out = rank_in[0] + ':' + \
-                hashlib.md5(str(rank_in).encode('utf-8')).hexdigest()
-        else:
-            rank_out = np.nan
-    return rank_out
+    non_7bit = ranks_in.str.contains(r'[^A-Za-z0-9_.]', regex=True, na=False)
+    is_rank = ranks_in.str.match(r'^[kdpcofgs]', na=False)
+    to_hash = non_7bit & is_rank
+    ranks_out[to_hash] = [rank[0] + ':' + hashlib.md5(rank.encode('utf-8')).hexdigest()
+                          for rank in ranks_in[to_hash]]
+    ranks_out[non_7bit & ~is_rank] = np.nan
+    return ranks_out
 
 
-def _detect_empty_ph_ranks(rank_in):
-    result = False
-    if rank_in == np.nan:
-        result = True
-    else:
-        pattern = r"^[dpcofgs]:$"
-        result = bool(re.match(pattern, rank_in))
-    return result
+def _detect_empty_ph_ranks(ranks_in):
+    # missing ranks count as empty place holders too
+    return ranks_in.isna() | ranks_in.str.match(r"^[dpcofgs]:$", na=True).astype(bool)
 
 
-def _join_levels_for_usearch(tax_series_in):
+def _join_levels_for_usearch(tax_df_in, depth):
     # This pile of 💩 is here for one reason:
     # if a non authoritive database contains a place holder in a parent rank and also have a non-empty child rank
-    usearch_tax_anno_str = ';tax='
-    for level, (index, rank) in enumerate(tax_series_in.items(), 1):
-        detection_res = _detect_empty_ph_ranks(rank)
-        if detection_res:
-            break
-        else:
-            if level == 1:
-                usearch_tax_anno_str = usearch_tax_anno_str + rank
-            else:
-                usearch_tax_anno_str = usearch_tax_anno_str + ',' + rank
-    usearch_tax_anno_str = usearch_tax_anno_str + ';'
-    return usearch_tax_anno_str
+    # the join stops at the first empty (or missing) rank of each row,
+    # ``depth`` is the number of ranks kept
+    rows = zip(*[tax_df_in[col].to_numpy(dtype=object) for col in tax_df_in.columns])
+    return pd.Series([';tax=' + ','.join(ranks[:d]) + ';'
+                      for ranks, d in zip(rows, depth.tolist())],
+                     index=tax_df_in.index, dtype=object)
+
+
+def _normalise_rank_labels(labels, memo):
+    # q2 rank labels -> usearch rank labels and their empty place holder
+    # flags. memo maps every label seen so far to (usearch label, is empty),
+    # only labels missing from it go through the rewriting, the results are
+    # broadcast back to the rows through factorize codes
+    codes, uniques = pd.factorize(labels)
+    new_labels = [label for label in uniques if label not in memo]
+    if new_labels:
+        u_labels = pd.Series(new_labels, dtype=object)
+        u_labels = _replace_q2_split_w_usearch_split_and_remove_leading_trailing_blanks(
+            u_labels)
+        u_labels = _replace_non_7bit_ascii_chars(u_labels)
+        memo.update(zip(new_labels, zip(u_labels, _detect_empty_ph_ranks(u_labels))))
+    # factorize codes missing values as -1, i.e. the entry appended last
+    u_ranks = np.array([memo[label][0] for label in uniques] + [np.nan], dtype=object)
+    is_empty = np.array([memo[label][1] for label in uniques] + [True], dtype=bool)
+    return u_ranks[codes], is_empty[codes]
 
 
 def _make_tmp_tax_mapping_df(tax_df_in):
 
     tax_df_out = tax_df_in.copy()
 
-    max_level, tax_rank_split_se = _split_tax_into_ranks_and_get_max_levels(
-        tax_df_in, ';')
+    # references repeat the same lineage over and over, do all the work on
+    # the distinct lineages and broadcast the result to the rows at the end
+    lineage_codes, lineages = pd.factorize(tax_df_in['Taxon'].astype(str))
+
+    # need to confirm if sintax accepts non-7-rank systems
+    tax_rank_split_df = pd.Series(lineages, dtype=object).str.split(';', expand=True)
+    max_level = tax_rank_split_df.shape[1]
+    if max_level > 7:
+        raise KeyError('according to the doc, sintax only supports up to 7 levels')
 
     ori_tax_cols_lst = ['q2_' + 'level' + '_' + str(i) for i in range(1, max_level + 1)]
     u_tax_cols_lst = ['usearch_' + 'level' + '_' +
                       str(i) for i in range(1, max_level + 1)]
 
-    # 💩 super slow but works
-    tax_df_out[ori_tax_cols_lst] = tax_rank_split_se.apply(pd.Series)
+    tax_rank_split_df.columns = ori_tax_cols_lst
+    # shorter lineages are padded with None, make them proper NaNs
+    tax_rank_split_df = tax_rank_split_df.fillna(np.nan)
+
+    # number of leading non-empty ranks of each lineage
+    depth = np.zeros(len(tax_rank_split_df), dtype=np.int64)
+    not_stopped = np.ones(len(tax_rank_split_df), dtype=bool)
+    # shared by all levels, a label is never normalised twice
+    rank_memo = {}
+    for ori_level, u_level in zip(ori_tax_cols_lst, u_tax_cols_lst):
+        u_ranks, is_empty = _normalise_rank_labels(
+            tax_rank_split_df[ori_level], rank_memo)
+        tax_rank_split_df[u_level] = u_ranks
+        not_stopped &= ~is_empty
+        depth += not_stopped
 
-    tax_df_out[u_tax_cols_lst] = tax_df_out[ori_tax_cols_lst]
+    tax_rank_split_df['usearch_tax'] = _join_levels_for_usearch(
+        tax_rank_split_df[u_tax_cols_lst], depth)
 
-    for u_level in u_tax_cols_lst:
-        tax_df_out[u_level] = tax_df_out[u_level].apply(
-            _replace_q2_split_w_usearch_split_and_remove_leading_trailing_blanks)
-        tax_df_out[u_level] = tax_df_out[u_level].apply(_replace_non_7bit_ascii_chars)
-    tax_df_out['usearch_tax'] = tax_df_out[u_tax_cols_lst].apply(
-        _join_levels_for_usearch, axis=1)
+    for col in tax_rank_split_df.columns:
+        tax_df_out[col] = tax_rank_split_df[col].to_numpy(dtype=object)[lineage_codes]
 
     return tax_df_out
 
 
+# reference records converted per write
+_REF_FASTA_BLOCK_RECORDS = 10000
+
+
 def _convert_q2_seqs_and_taxa_to_utax(working_dir, reference_reads, reference_taxonomy, verbose):
-    ref_reads_se = reference_reads
-    ref_reads_se.name = 'Seqs'
-    ref_reads_se.index.name = 'Feature ID'
     ref_taxa_df = reference_taxonomy
     # check if dumping tax_df to pickle is nessesary with low spec pcs
     # silva 138.1 only took 72m mem, no need here
@@ -132,26 +156,104 @@ def _convert_q2_seqs_and_taxa_to_utax(working_dir, reference_reads, reference_ta
 
     tmp_taxa_map_df = _make_tmp_tax_mapping_df(ref_taxa_df)
 
+    # reference_reads is the artifact's fasta file, it is streamed straight
+    # into the usearch fasta, never loaded into skbio objects
     op_fa = os.path.join(working_dir, 'ref_seqs_tax.fa')
-    with open(op_fa, 'wt') as fh:
-        for index, item in ref_reads_se.items():
-            tax_info = tmp_taxa_map_df.at[index, 'usearch_tax']
-            seq_to_dump = skbio.DNA(str(item).upper(), metadata={
-                                    'id': index + tax_info})
-            seq_to_dump.write(fh, format="fasta", max_width=80)
+    with open(str(reference_reads), 'rb') as in_fh, open(op_fa, 'wb') as out_fh:
+        records = iter_fasta_records(in_fh)
+        while True:
+            block = list(islice(records, _REF_FASTA_BLOCK_RECORDS))
+            if not block:
+                break
+            _write_utax_ref_fasta_block(out_fh, block, tmp_taxa_map_df['usearch_tax'])
 
     return tmp_taxa_map_df
 
 
-def _build_udb():
-    # seemed unnessasary, sintax builds one on the fly, and tmp dirs don't presist in a q2 pipeline
-    pass
+def _write_utax_ref_fasta_block(out_fh, block, usearch_tax_se):
+    # the ids are joined with the taxonomy in one go and the sequences are
+    # uppercased in one go, the block is then written with a single call
+    ids = [label.split(None, 1)[0].decode('utf-8') for label, _ in block]
+    tax_infos = usearch_tax_se.reindex(ids)
+    if tax_infos.isna().any():
+        raise KeyError('reference sequences without taxonomy: ' +
+                       ', '.join(tax_infos.index[tax_infos.isna()][:10]))
+    seqs = b'\n'.join([seq for _, seq in block]).upper().split(b'\n')
+    labels = [index + tax_info for index, tax_info in zip(ids, tax_infos)]
+    write_fasta_records(out_fh, zip(labels, seqs))
+
+
+def _build_udb(working_dir, verbose):
+    # index ref_seqs_tax.fa once, sintax would do the same on the fly at
+    # every run
+    cmd = ['usearch', '-makeudb_sintax', os.path.join(working_dir, 'ref_seqs_tax.fa'),
+           '-output', os.path.join(working_dir, 'ref_seqs_tax.udb')]
+
+    run_commands([cmd], working_dir, verbose)
+
+
+# bump when the conversion to the usearch reference changes, so stale
+# cache entries are no longer picked up
+_REF_DB_LAYOUT_VERSION = 2
+
+
+def _write_taxa_map(taxa_map_df, fp):
+    taxa_map_df.to_csv(fp, sep='\t')
+
+
+def _read_taxa_map(fp):
+    # only empty fields are missing ranks, "NA" and friends are taxa names
+    return pd.read_csv(fp, sep='\t', index_col=0, dtype=str,
+                       keep_default_na=False, na_values=[''])
+
+
+def _usearch_version(working_dir):
+    # udb files are tied to the usearch build that wrote them
+    result = run_command(['usearch', '-version'], working_dir, verbose=False)
+    with open(result.stdout_fp, 'rt') as fh:
+        return fh.read().strip()
+
+
+def _ref_db_cache_key(reference_reads, reference_taxonomy, usearch_version):
+    hasher = hashlib.sha256()
+    hasher.update(
+        ('%d\t%s\n' % (_REF_DB_LAYOUT_VERSION, usearch_version)).encode('utf-8'))
+    hash_file(hasher, str(reference_reads))
+    hash_records(hasher, reference_taxonomy['Taxon'].items())
+    return hasher.hexdigest()
+
+
+def _get_ref_db(working_dir, reference_reads, reference_taxonomy, verbose):
+    # returns the database for usearch -sintax and the taxa mapping table
+    cache_root = cache_dir('sintax')
+
+    if cache_root is None:
+        taxa_map_df = _convert_q2_seqs_and_taxa_to_utax(
+            working_dir, reference_reads, reference_taxonomy, verbose)
+        return os.path.join(working_dir, 'ref_seqs_tax.fa'), taxa_map_df
+
+    key = _ref_db_cache_key(
+        reference_reads, reference_taxonomy, _usearch_version(working_dir))
+
+    def build(entry_dir):
+        taxa_map_df = _convert_q2_seqs_and_taxa_to_utax(
+            entry_dir, reference_reads, reference_taxonomy, verbose)
+        _write_taxa_map(taxa_map_df, os.path.join(entry_dir, 'taxa_map.tsv'))
+        _build_udb(entry_dir, verbose)
+
+    entry_dir = get_or_build(cache_root, key, build, verbose)
+
+    return (os.path.join(entry_dir, 'ref_seqs_tax.udb'),
+            _read_taxa_map(os.path.join(entry_dir, 'taxa_map.tsv')))
+
 
+def _run_sintax(working_dir, query_seqs_fp, strand, threads, verbose, db_fp=None):
+    if db_fp is None:
+        db_fp = os.path.join(working_dir, 'ref_seqs_tax.fa')
 
-def _run_sintax(working_dir, query_seqs_fp, strand, threads, verbose):
     # build sintax command
-    cmd = ['usearch', '-sintax', query_seqs_fp, '-db', os.path.join(
-        working_dir, 'ref_seqs_tax.fa'), '-tabbedout', os.path.join(working_dir, 'sintax.tsv')]
+    cmd = ['usearch', '-sintax', query_seqs_fp, '-db', db_fp,
+           '-tabbedout', os.path.join(working_dir, 'sintax.tsv')]
 
     if strand == 'plus':
         cmd += ['-strand', 'plus']
@@ -161,7 +263,7 @@ def _run_sintax(working_dir, query_seqs_fp, strand, threads, verbose):
     if threads != 1:
         cmd += ['-threads', str(threads)]
 
-    run_commands([cmd])
+    run_commands([cmd], working_dir, verbose)
 
 
 def _rm_conf_value_and_trim_fp_ranks(x, cut_off=float):
@@ -214,18 +316,26 @@ def _split_utax_and_get_conf_lr(usearch_tax_df_in, confidence):
     return tax_rank_split_df, id_conf_df
 
 
-def _map_utax_to_q2_tax(tax_rank_split_in, taxa_map_df):
-    # split input and map into sep dfs, left join and concat back
-    levels = len(tax_rank_split_in.columns)
+def _make_utax_to_q2_maps(taxa_map_df):
+    # usearch rank label -> q2 rank label for every level, built once and
+    # shared by every strand
+    maps = {}
+    for u_col in taxa_map_df.columns:
+        if not u_col.startswith('usearch_level_'):
+            continue
+        q2_col = 'q2_' + u_col[len('usearch_'):]
+        pairs = taxa_map_df[[u_col, q2_col]].dropna().drop_duplicates()
+        maps[u_col] = dict(zip(pairs[u_col], pairs[q2_col]))
+    return maps
+
+
+def _map_utax_to_q2_tax(tax_rank_split_in, utax_to_q2_maps):
+    # labels without a q2 counterpart are kept as they are
     tax_rank_split_mapped_to_q2_tax = tax_rank_split_in.copy()
-    for i in range(1, levels + 1):
-        key = "level_" + str(i)
-        taxa_map_df_sub_level = taxa_map_df[['usearch_' + key, 'q2_' + key]]
-        taxa_map_df_sub_level_uni = taxa_map_df_sub_level.drop_duplicates().dropna()
-        taxa_map_df_sub_level_uni_dict = taxa_map_df_sub_level_uni.set_index(
-            'usearch_' + key).iloc[:, 0].to_dict()
-        tax_rank_split_mapped_to_q2_tax['usearch_' + key] = tax_rank_split_in['usearch_' + key].replace(
-            taxa_map_df_sub_level_uni_dict)
+    for col in tax_rank_split_in.columns:
+        ranks = tax_rank_split_in[col]
+        mapped = ranks.map(utax_to_q2_maps.get(col, {}))
+        tax_rank_split_mapped_to_q2_tax[col] = mapped.where(mapped.notna(), ranks)
     return tax_rank_split_mapped_to_q2_tax
 
 
@@ -301,6 +411,8 @@ def _collect_sintax_anno_to_q2_anno(working_dir, taxa_map_df, empty_df_w_input_s
 
     usearch_tax.columns = ['Taxon', 'Strand']
 
+    utax_to_q2_maps = _make_utax_to_q2_maps(taxa_map_df)
+
     # rewrite in a less 💩 way here later...
     if strand != 'plus':
         usearch_tax_both = {}
@@ -318,7 +430,7 @@ def _collect_sintax_anno_to_q2_anno(working_dir, taxa_map_df, empty_df_w_input_s
                 value, confidence)
 
             q2_tax_rank_splits[key] = _map_utax_to_q2_tax(
-                usearch_tax_rank_split_dfs[key], taxa_map_df)
+                usearch_tax_rank_split_dfs[key], utax_to_q2_maps)
 
             q2_taxs[key] = _join_q2_tax(q2_tax_rank_splits[key])
 
@@ -368,7 +480,8 @@ def _collect_sintax_anno_to_q2_anno(working_dir, taxa_map_df, empty_df_w_input_s
         usearch_tax_rank_split_df, id_conf_df = _split_utax_and_get_conf_lr(
             usearch_tax, confidence)
 
-        q2_tax_rank_split = _map_utax_to_q2_tax(usearch_tax_rank_split_df, taxa_map_df)
+        q2_tax_rank_split = _map_utax_to_q2_tax(
+            usearch_tax_rank_split_df, utax_to_q2_maps)
 
         q2_tax = _join_q2_tax(q2_tax_rank_split)
 
@@ -388,7 +501,7 @@ def _collect_sintax_anno_to_q2_anno(working_dir, taxa_map_df, empty_df_w_input_s
 
 
 def sintax(query: pd.Series,
-           reference_reads: pd.Series,
+           reference_reads: DNAFASTAFormat,
            reference_taxonomy: pd.DataFrame,
            # limited test suggest it's common for sintax to report a better match in rev-comp using plus only 16s as input
            # maybe throw in orinet as a precaution? warn user?
@@ -407,12 +520,68 @@ def sintax(query: pd.Series,
         empty_df_w_input_seqs_labs = _get_input_seqs_ids_and_dump_to_fasta(
             usearch_wd, query)
 
+        # converted and indexed once per reference, then reused from the cache
+        db_fp, taxa_map_df = _get_ref_db(
+            usearch_wd, reference_reads, reference_taxonomy, verbose)
+
+        query_fp = os.path.join(usearch_wd, 'query.fasta')
+
+        _run_sintax(usearch_wd, query_fp, strand, threads, verbose, db_fp=db_fp)
+
+        classification = _collect_sintax_anno_to_q2_anno(
+            usearch_wd, taxa_map_df, empty_df_w_input_seqs_labs, strand, confidence,
+            verbose)
+
+    return classification
+
+
+def build_sintax_db(reference_reads: DNAFASTAFormat,
+                    reference_taxonomy: pd.DataFrame
+                    ) -> USEARCHSintaxDBDirFmt:
+
+    verbose = True
+
+    sintax_db = USEARCHSintaxDBDirFmt()
+
+    with tempfile.TemporaryDirectory() as usearch_wd:
+
         taxa_map_df = _convert_q2_seqs_and_taxa_to_utax(
             usearch_wd, reference_reads, reference_taxonomy, verbose)
 
+        _build_udb(usearch_wd, verbose)
+
+        shutil.move(os.path.join(usearch_wd, 'ref_seqs_tax.udb'),
+                    os.path.join(str(sintax_db), 'ref_seqs_tax.udb'))
+
+    _write_taxa_map(taxa_map_df, os.path.join(str(sintax_db), 'taxa_map.tsv'))
+
+    return sintax_db
+
+
+def sintax_prebuilt(query: pd.Series,
+                    reference_db: USEARCHSintaxDBDirFmt,
+                    strand: str = 'plus',
+                    threads: str = "auto",
+                    confidence: float = 0.8
+                    ) -> pd.DataFrame:
+
+    verbose = True
+
+    if threads == "auto":
+        threads = os.cpu_count() - 3
+
+    # the reference was converted and indexed by build_sintax_db
+    db_fp = os.path.join(str(reference_db), 'ref_seqs_tax.udb')
+    taxa_map_df = _read_taxa_map(os.path.join(str(reference_db), 'taxa_map.tsv'))
+
+    with tempfile.TemporaryDirectory() as usearch_wd:
+
+        empty_df_w_input_seqs_labs = _get_input_seqs_ids_and_dump_to_fasta(
+            usearch_wd, query)
+
         query_fp = os.path.join(usearch_wd, 'query.fasta')
 
-        _run_sintax(usearch_wd, query_fp, strand, threads, verbose)
+        _run_sintax(usearch_wd, query_fp, strand, threads, verbose, db_fp=db_fp)
 
         classification = _collect_sintax_anno_to_q2_anno(
             usearch_wd, taxa_map_df, empty_df_w_input_seqs_labs, strand, confidence, verbose)
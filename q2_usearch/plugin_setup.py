@@ -22,6 +22,8 @@ import q2_usearch
 
 # Register Usearch stats fmt
 from q2_usearch._format import USEARCHStats, USEARCHStatsFormat, USEARCHStatsDirFmt
+from q2_usearch._format import (USEARCHSintaxDB, USEARCHUDBFormat, USEARCHTaxaMapFormat,
+                                USEARCHSintaxDBDirFmt)
 
 citations = Citations.load("citations.bib", package="q2_usearch")
 
@@ -52,6 +54,10 @@ plugin.methods.register_function(
         'unoise_alpha': Float % Range(0.0, None),
         'n_threads': Int % Range(1, None) | Str % Choices(['auto']),
         'use_vsearch': Bool,
+        'native_filter': Bool,
+        'filter_before_pooling': Bool,
+        'native_derep': Bool,
+        'derep_shards': Int % Range(1, None),
     },
     name="Pool and denoise valid-data.",
     description='This Method Pools All Samples Together and Extracts Biological Reads Using the Unoise3 Algorithm. \n' +
@@ -77,7 +83,26 @@ plugin.methods.register_function(
         'unoise_alpha': 'See UNOISE2 paper for definition',
         'n_threads': ('The number of threads to use for computation. '
                       'If set to auto, the plug-in will use (all vcores - 3) present on the node.'),
-        'use_vsearch': 'Use vsearch instead of usearch for computation . '
+        'use_vsearch': 'Use vsearch instead of usearch for computation . ',
+        'native_filter': ('Perform maxEE quality filtering in-process instead of '
+                          'calling u/vsearch -fastq_filter. Reads are filtered in '
+                          'parallel batches and per sample counts are collected in the '
+                          'same pass. '),
+        'filter_before_pooling': ('Quality filter each sample on its own, in parallel, '
+                                  'and pool only the reads passing the filter. The '
+                                  'unfiltered reads are never written to the temp dir, '
+                                  'which cuts the scratch space needed for large runs. '
+                                  'Implies native_filter. Since the low quality reads '
+                                  'are gone, usearch -otutab maps the filtered reads '
+                                  'instead of all reads, so slightly fewer reads are '
+                                  'mapped to each feature. '),
+        'native_derep': ('Dereplicate filtered reads in-process instead of calling '
+                         'u/vsearch -fastx_uniques. Memory grows with the number of '
+                         'unique sequences only. '),
+        'derep_shards': ('Only used with native_derep. Split the filtered reads into '
+                         'this many shards by sequence and dereplicate every shard in '
+                         'its own process. Peak memory per process drops accordingly, '
+                         'the output is the same as with a single shard. ')
     },
     inputs={
         'demultiplexed_sequences': SampleData[SequencesWithQuality] | SampleData[JoinedSequencesWithQuality]},
@@ -105,6 +130,10 @@ plugin.methods.register_function(
         'max_ee': Float % Range(0.0, None),
         'min_size': Int % Range(1, None),
         'n_threads': Int % Range(1, None) | Str % Choices(['auto']),
+        'native_filter': Bool,
+        'filter_before_pooling': Bool,
+        'native_derep': Bool,
+        'derep_shards': Int % Range(1, None),
     },
     name="Pool and cluster valid-data at 97% identity.",
     description='This Method Pools All Samples Together and Cluster Them into 97% OTUs using the Uparse Algorithm. \n' +
@@ -128,6 +157,25 @@ plugin.methods.register_function(
                      'Default is 2, which means unique reads are discarded. '),
         'n_threads': ('The number of threads to use for computation. '
                       'If set to auto, the plug-in will use (all vcores - 3) present on the node.'),
+        'native_filter': ('Perform maxEE quality filtering in-process instead of '
+                          'calling u/vsearch -fastq_filter. Reads are filtered in '
+                          'parallel batches and per sample counts are collected in the '
+                          'same pass. '),
+        'filter_before_pooling': ('Quality filter each sample on its own, in parallel, '
+                                  'and pool only the reads passing the filter. The '
+                                  'unfiltered reads are never written to the temp dir, '
+                                  'which cuts the scratch space needed for large runs. '
+                                  'Implies native_filter. Since the low quality reads '
+                                  'are gone, usearch -otutab maps the filtered reads '
+                                  'instead of all reads, so slightly fewer reads are '
+                                  'mapped to each feature. '),
+        'native_derep': ('Dereplicate filtered reads in-process instead of calling '
+                         'u/vsearch -fastx_uniques. Memory grows with the number of '
+                         'unique sequences only. '),
+        'derep_shards': ('Only used with native_derep. Split the filtered reads into '
+                         'this many shards by sequence and dereplicate every shard in '
+                         'its own process. Peak memory per process drops accordingly, '
+                         'the output is the same as with a single shard. ')
     },
     inputs={
         'demultiplexed_sequences': SampleData[SequencesWithQuality] | SampleData[JoinedSequencesWithQuality]},
@@ -158,6 +206,10 @@ plugin.methods.register_function(
         'unoise_alpha': Float % Range(0.0, None),
         'n_threads': Int % Range(1, None) | Str % Choices(['auto']),
         'use_vsearch': Bool,
+        'native_filter': Bool,
+        'filter_before_pooling': Bool,
+        'native_derep': Bool,
+        'derep_shards': Int % Range(1, None),
     },
     name="Pool, denoise then cluster valid-data.",
     description='This Method Pools All Samples Together, then Extracts Biological Reads Using the Unoise3 Algorithm, ' +
@@ -185,7 +237,26 @@ plugin.methods.register_function(
         'unoise_alpha': 'See UNOISE2 paper for definition',
         'n_threads': ('The number of threads to use for computation. '
                       'If set to auto, the plug-in will use (all vcores - 3) present on the node.'),
-        'use_vsearch': 'Use vsearch instead of usearch for computation . '
+        'use_vsearch': 'Use vsearch instead of usearch for computation . ',
+        'native_filter': ('Perform maxEE quality filtering in-process instead of '
+                          'calling u/vsearch -fastq_filter. Reads are filtered in '
+                          'parallel batches and per sample counts are collected in the '
+                          'same pass. '),
+        'filter_before_pooling': ('Quality filter each sample on its own, in parallel, '
+                                  'and pool only the reads passing the filter. The '
+                                  'unfiltered reads are never written to the temp dir, '
+                                  'which cuts the scratch space needed for large runs. '
+                                  'Implies native_filter. Since the low quality reads '
+                                  'are gone, usearch -otutab maps the filtered reads '
+                                  'instead of all reads, so slightly fewer reads are '
+                                  'mapped to each feature. '),
+        'native_derep': ('Dereplicate filtered reads in-process instead of calling '
+                         'u/vsearch -fastx_uniques. Memory grows with the number of '
+                         'unique sequences only. '),
+        'derep_shards': ('Only used with native_derep. Split the filtered reads into '
+                         'this many shards by sequence and dereplicate every shard in '
+                         'its own process. Peak memory per process drops accordingly, '
+                         'the output is the same as with a single shard. ')
     },
     inputs={
         'demultiplexed_sequences': SampleData[SequencesWithQuality] | SampleData[JoinedSequencesWithQuality]},
@@ -238,6 +309,62 @@ plugin.methods.register_function(
     }
 )
 
+plugin.methods.register_function(
+    function=q2_usearch.build_sintax_db,
+    parameters={},
+    name="Build a reusable sintax reference database.",
+    description='This Method Converts QIIME Style Reference Reads And Taxonomy Into ' +
+    'a Usearch Formatted Reference And Indexes It (usearch -makeudb_sintax). \n' +
+    "Use the Result With 'sintax-prebuilt' to Skip the Conversion And Indexing at " +
+    'Every Run. ',
+    citations=[citations['edgar2016sintax']],
+    inputs={
+        'reference_reads': FeatureData[Sequence],
+        'reference_taxonomy': FeatureData[Taxonomy]
+    },
+    input_descriptions={
+        'reference_reads': 'Reference sequences.',
+        'reference_taxonomy': 'Reference taxonomy labels.'
+    },
+    outputs=[('sintax_db', USEARCHSintaxDB)],
+    output_descriptions={
+        'sintax_db': ('Usearch udb index of the reference and the mapping back to the '
+                      'reference taxonomy.')
+    }
+)
+
+plugin.methods.register_function(
+    function=q2_usearch.sintax_prebuilt,
+    parameters={
+        'strand': Str % Choices('plus', 'both'),
+        'threads': Int % Range(1, None) | Str % Choices(['auto']),
+        'confidence': Float % Range(0.1, 1.0)
+    },
+    name="Rapidly classify reads by taxon using sintax and a prebuilt database.",
+    description=('Same as sintax, but against a reference database built with '
+                 'build-sintax-db. '),
+    citations=[citations['edgar2016sintax']],
+    parameter_descriptions={
+        'strand': ('Align against reference sequences in forward ("plus"), '
+                   'or both directions ("both").'),
+        'threads': ('The number of threads to use for computation. If set to auto, '
+                    'the plug-in will use (all vcores - 3) present on the node.'),
+        'confidence': 'Confidence threshold for limiting taxonomic depth. '
+    },
+    inputs={
+        'query': FeatureData[Sequence],
+        'reference_db': USEARCHSintaxDB
+    },
+    input_descriptions={
+        'query': 'Query sequences.',
+        'reference_db': 'Reference database built with build-sintax-db.'
+    },
+    outputs=[('classification', FeatureData[Taxonomy])],
+    output_descriptions={
+        'classification': 'Taxonomy classifications of query sequences.'
+    }
+)
+
 ####################
 # modified from q2-vsearch
 
@@ -257,6 +384,8 @@ plugin.methods.register_function(
         'maxmergelen': Int % Range(0, None),
         # 'preset': Int % None | Str % Choices(['double_reigon_short_overlap', 'double_reigon_long_overlap', 'signle_reigon_long_overlap']),
         'threads': Int % Range(1, None) | Str % Choices(['auto']),
+        'streaming': Bool,
+        'compression_level': Int % Range(1, 9, inclusive_end=True),
     },
     outputs=[
         ('merged_sequences', SampleData[JoinedSequencesWithQuality]),
@@ -283,7 +412,17 @@ plugin.methods.register_function(
         # 'preset': ('Predefined parameters for commonly used 16s protocols nowadays. '
         #            'Setting this will override parameters set above. '),
         'threads': ('The number of threads to use for computation. '
-                    'Default is auto, which automaticlly scales up to 10 vcores if available. ')
+                    'Default is auto, which uses all vcores present on the node. '
+                    'When enough threads are available, several samples are merged '
+                    'concurrently and the threads are split between them. '),
+        'streaming': ('Stream reads in and out of usearch through named pipes, '
+                      'decompressing the inputs and compressing the outputs on the fly '
+                      'instead of keeping uncompressed copies in the temp dir. '
+                      'Set it to False if your temp dir does not support named '
+                      'pipes. '),
+        'compression_level': ('gzip compression level of the output reads, from 1 '
+                              '(fastest) to 9 (smallest). Spare threads are used to '
+                              'compress blocks of the output in parallel. ')
     },
     output_descriptions={
         'merged_sequences': 'The merged sequences.',
@@ -303,3 +442,8 @@ plugin.register_formats(USEARCHStatsFormat, USEARCHStatsDirFmt)
 plugin.register_semantic_types(USEARCHStats)
 plugin.register_semantic_type_to_format(
     SampleData[USEARCHStats], USEARCHStatsDirFmt)
+
+# Register sintax reference db fmt
+plugin.register_formats(USEARCHUDBFormat, USEARCHTaxaMapFormat, USEARCHSintaxDBDirFmt)
+plugin.register_semantic_types(USEARCHSintaxDB)
+plugin.register_semantic_type_to_format(USEARCHSintaxDB, USEARCHSintaxDBDirFmt)